@@ -1,6 +1,8 @@
 from autogen import ConversableAgent
 from dotenv import load_dotenv
-import os, csv, json, re
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+from collections import deque
+import os, csv, json, queue, re, threading, time, argparse
 
 load_dotenv()
 
@@ -14,6 +16,62 @@ llm_config = {
     "cache_seed": 13   # 类似的问题，不会再次请求，而是去到缓存中查询，并返回结果
 }
 
+# 并发处理的摘要数，以及全局每分钟请求数 / token 数上限（0 表示不限）
+IE_CONCURRENCY = int(os.getenv("IE_CONCURRENCY", 8))
+IE_RPM = int(os.getenv("IE_RPM", 0))
+IE_TPM = int(os.getenv("IE_TPM", 0))
+# 泛化 / 分类阶段的工作线程数（同时在途的批次数），以及每批实体数
+IE_BATCH_CONCURRENCY = int(os.getenv("IE_BATCH_CONCURRENCY", 8))
+IE_BATCH_SIZE = int(os.getenv("IE_BATCH_SIZE", 10))
+# 流水线各阶段队列长度，队列满时上游阻塞（背压）
+IE_STAGE_QUEUE = int(os.getenv("IE_STAGE_QUEUE", 32))
+
+
+def estimate_tokens(text):
+    # 4 字符 ≈ 1 token 的粗略估算
+    return len(text) // 4 + 1
+
+
+class RateLimiter:
+    """
+    滑动窗口限速器，所有线程共享，同时约束每分钟请求数 (rpm) 与 token 数 (tpm)。
+    请求前按输入估算 token 占用额度，拿到回复后再把输出的 token 数计入窗口。
+    """
+
+    def __init__(self, rpm=0, tpm=0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._events = deque()  # (时间戳, 请求数, token 数)
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=0):
+        if not self.rpm and not self.tpm:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._events and now - self._events[0][0] >= 60:
+                    self._events.popleft()
+                used_requests = sum(n for _, n, _ in self._events)
+                used_tokens = sum(t for _, _, t in self._events)
+                request_ok = not self.rpm or used_requests < self.rpm
+                # 单个请求超过 tpm 时只要窗口为空就放行，避免永久阻塞
+                token_ok = not self.tpm or used_tokens + tokens <= self.tpm or not self._events
+                if request_ok and token_ok:
+                    self._events.append((now, 1, tokens))
+                    return
+                wait = 60 - (now - self._events[0][0])
+            time.sleep(max(wait, 0.05))
+
+    def add_tokens(self, tokens):
+        """补记输出 token，不占请求数"""
+        if self.tpm:
+            with self._lock:
+                self._events.append((time.monotonic(), 0, tokens))
+
+
+rate_limiter = RateLimiter(IE_RPM, IE_TPM)
+
 # 分类路径嵌套结构（供泛化与分类 Agent 使用）
 classification_path_ontology = """
 你需要参考以下【材料科学分类体系】：
@@ -156,7 +214,9 @@ classifier = build_agent(
 )
 
 def call_agent(agent, input_text):
+    rate_limiter.acquire(estimate_tokens(agent.system_message + input_text))
     response = agent.generate_reply(messages=[{"role": "user", "content": input_text}])
+    rate_limiter.add_tokens(estimate_tokens(response or ""))
     response = re.sub(r"^```json\s*|\s*```$", "", response.strip(), flags=re.IGNORECASE)
     try:
         return json.loads(response)
@@ -177,75 +237,241 @@ def extract_local_context(entity, full_text, window_size=50):
         contexts.add(context)
     return list(contexts)
 
-def process_abstract(abs_id, title, abstract, output_dir="outputs"):
-    os.makedirs(output_dir, exist_ok=True)
-    text = f"{title}\n{abstract}"
-    try:
-        raw_entities = call_agent(entity_extractor, text)
-        unique_entities = list(set(raw_entities))
-    except:
-        print(f"实体抽取失败： {abs_id}")
-        return
-        
-    # 批量收集所有实体的上下文
-    batch_entities = []
-    for entity in unique_entities:
-        local_contexts = extract_local_context(entity, text)
-        for context in local_contexts:
-            batch_entities.append({"entity": entity, "context": context})
-            
-    print(f"总实体数量: {len(batch_entities)}")
-    
-    # 检查输入长度，如果太长则分批处理
-    batch_size = 10  # 每批处理10个实体
-    all_gen_results = {}
-    
-    for i in range(0, len(batch_entities), batch_size):
-        batch = batch_entities[i:i+batch_size]
-        print(f"处理批次 {i//batch_size + 1}: {len(batch)} 个实体")
-        
+class Stage:
+    """
+    流水线中的一个阶段：有界队列 + 固定数量的工作线程。
+    队列满时上游 put 阻塞，形成背压；统计处理数、忙碌时间与排队等待时间，用于定位瓶颈阶段。
+    """
+
+    def __init__(self, name, handler, workers, queue_size):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.processed = self.failed = self.max_queued = 0
+        self.busy = self.waited = 0.0
+        self._lock = threading.Lock()
+
+    def start(self):
+        for i in range(self.workers):
+            threading.Thread(target=self._loop, name=f"{self.name}-{i}", daemon=True).start()
+
+    def stop(self):
+        """每个工作线程一个结束标记，排在已入队的任务之后"""
+        for _ in range(self.workers):
+            self.queue.put(None)
+
+    def put(self, job, *args):
+        self.queue.put((time.monotonic(), job, args))
+        with self._lock:
+            self.max_queued = max(self.max_queued, self.queue.qsize())
+
+    def _loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            queued_at, job, args = item
+            ts = time.monotonic()
+            try:
+                # handler 返回 False 表示已处理的失败（如批次回复无法解析）
+                ok = self.handler(job, *args) is not False
+            except Exception as e:
+                # handler 内部已处理预期中的失败，这里兜底，避免调用方永远等待
+                ok = False
+                print(f"[{job.abs_id}] {self.name} 阶段异常： {e}")
+                job.finish(None)
+            with self._lock:
+                self.processed += 1
+                self.failed += 0 if ok else 1
+                self.waited += ts - queued_at
+                self.busy += time.monotonic() - ts
+
+    def metrics(self, elapsed):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "processed": self.processed,
+                "failed": self.failed,
+                "queued": self.queue.qsize(),
+                "max_queued": self.max_queued,
+                "busy_s": round(self.busy, 2),
+                "avg_wait_s": round(self.waited / self.processed, 3) if self.processed else 0.0,
+                "utilization": round(self.busy / (self.workers * elapsed), 3) if elapsed else 0.0,
+            }
+
+
+class AbstractJob:
+    """一篇摘要在流水线中的状态：各批次的泛化 / 分类结果按批次下标存放，全部批次结束后合并输出"""
+
+    def __init__(self, abs_id, title, abstract, output_dir):
+        self.abs_id = abs_id
+        self.text = f"{title}\n{abstract}"
+        self.output_dir = output_dir
+        self.future = Future()
+        self.submitted_at = time.monotonic()
+        self.seconds = None
+        self.batch_entities = []
+        self.gen_results = []
+        self.cls_results = []
+        self.pending = 0
+        self._lock = threading.Lock()
+
+    def batch_done(self):
+        """一个批次走完（成功或失败）；最后一个批次负责合并结果"""
+        with self._lock:
+            self.pending -= 1
+            last = self.pending == 0
+        if last:
+            self.finish(self.assemble())
+
+    def finish(self, result):
+        if not self.future.done():
+            self.seconds = round(time.monotonic() - self.submitted_at, 2)
+            self.future.set_result(result)
+
+    def assemble(self):
+        # 按批次顺序合并，同一实体出现在多个批次时后面的批次覆盖前面的，与串行处理一致
+        all_gen_results = {}
+        for batch_result in self.gen_results:
+            all_gen_results.update(batch_result or {})
+        if not all_gen_results:
+            print(f"所有泛化处理都失败了： {self.abs_id}")
+            return None
+        all_cls_results = {}
+        for batch_result in self.cls_results:
+            all_cls_results.update(batch_result or {})
+        if not all_cls_results:
+            print(f"所有分类处理都失败了： {self.abs_id}")
+            return None
+
+        result = build_result(self.batch_entities, all_gen_results, all_cls_results)
+        with open(os.path.join(self.output_dir, f"{self.abs_id}.json"), "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        return result
+
+
+def _call_agent_dict(agent, batch):
+    result = call_agent(agent, json.dumps(batch, ensure_ascii=False))
+    if not isinstance(result, dict):
+        raise ValueError("回复无法解析为 JSON 对象")
+    return result
+
+
+class StreamingPipeline:
+    """
+    实体抽取 → 泛化 → 分类 三阶段流式处理。
+    每篇摘要抽取完成后按批次进入泛化队列，每个泛化批次返回后立即把对应的分类批次送入分类队列，
+    不等同一摘要的其他泛化批次；不同摘要在各阶段之间互不等待。
+    """
+
+    def __init__(self, extract_workers=IE_CONCURRENCY, generalize_workers=IE_BATCH_CONCURRENCY,
+                 classify_workers=IE_BATCH_CONCURRENCY, queue_size=IE_STAGE_QUEUE, batch_size=IE_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.stages = {
+            "extract": Stage("抽取", self._extract, extract_workers, queue_size),
+            "generalize": Stage("泛化", self._generalize, generalize_workers, queue_size),
+            "classify": Stage("分类", self._classify, classify_workers, queue_size),
+        }
+        self.started_at = None
+        self._lock = threading.Lock()
+
+    def submit(self, abs_id, title, abstract, output_dir="outputs"):
+        """
+        提交一篇摘要，返回 AbstractJob；job.future 的结果为整理后的 dict，失败为 None。
+        抽取队列满时阻塞
+        """
+        with self._lock:
+            if self.started_at is None:
+                for stage in self.stages.values():
+                    stage.start()
+                self.started_at = time.monotonic()
+        os.makedirs(output_dir, exist_ok=True)
+        job = AbstractJob(abs_id, title, abstract, output_dir)
+        self.stages["extract"].put(job)
+        return job
+
+    def close(self):
+        """已提交的摘要处理完后结束全部工作线程"""
+        with self._lock:
+            if self.started_at is None:
+                return
+            for stage in self.stages.values():
+                stage.stop()
+
+    def _extract(self, job):
         try:
-            batch_gen_input = json.dumps(batch, ensure_ascii=False)
-            batch_gen_result = call_agent(generalizer, batch_gen_input)
-            all_gen_results.update(batch_gen_result)
+            raw_entities = call_agent(entity_extractor, job.text)
+            unique_entities = list(set(raw_entities))
+        except:
+            print(f"实体抽取失败： {job.abs_id}")
+            job.finish(None)
+            return False
+
+        # 批量收集所有实体的上下文
+        for entity in unique_entities:
+            for context in extract_local_context(entity, job.text):
+                job.batch_entities.append({"entity": entity, "context": context})
+        print(f"[{job.abs_id}] 总实体数量: {len(job.batch_entities)}")
+
+        # 检查输入长度，如果太长则分批处理
+        batches = [job.batch_entities[i:i+self.batch_size] for i in range(0, len(job.batch_entities), self.batch_size)]
+        if not batches:
+            job.finish(job.assemble())
+            return
+        job.gen_results = [None] * len(batches)
+        job.cls_results = [None] * len(batches)
+        job.pending = len(batches)
+        for i, batch in enumerate(batches):
+            self.stages["generalize"].put(job, i, batch)
+
+    def _generalize(self, job, index, batch):
+        print(f"[{job.abs_id}] 泛化批次 {index + 1}: {len(batch)} 个实体")
+        try:
+            job.gen_results[index] = _call_agent_dict(generalizer, batch)
         except Exception as e:
-            print(f"批次 {i//batch_size + 1} 泛化失败： {e}")
-            continue
-    
-    if not all_gen_results:
-        print(f"所有泛化处理都失败了： {abs_id}")
-        return
-    
-    # 批量分类处理
-    batch_cls_input = []
-    for item in batch_entities:
-        entity = item["entity"]
-        context = item["context"]
-        gen_paths = all_gen_results.get(entity, [])
-        batch_cls_input.append({
-            "entity": entity,
-            "context": context,
-            "generalization": gen_paths
-        })
-        
-    # 分批处理分类
-    all_cls_results = {}
-    for i in range(0, len(batch_cls_input), batch_size):
-        batch = batch_cls_input[i:i+batch_size]
-        print(f"分类处理批次 {i//batch_size + 1}: {len(batch)} 个实体")
-        
+            print(f"[{job.abs_id}] 泛化批次 {index + 1} 失败： {e}")
+            job.batch_done()
+            return False
+        cls_batch = [
+            {"entity": item["entity"], "context": item["context"],
+             "generalization": job.gen_results[index].get(item["entity"], [])}
+            for item in batch
+        ]
+        self.stages["classify"].put(job, index, cls_batch)
+
+    def _classify(self, job, index, batch):
+        print(f"[{job.abs_id}] 分类批次 {index + 1}: {len(batch)} 个实体")
         try:
-            batch_cls_json = json.dumps(batch, ensure_ascii=False)
-            batch_cls_result = call_agent(classifier, batch_cls_json)
-            all_cls_results.update(batch_cls_result)
+            job.cls_results[index] = _call_agent_dict(classifier, batch)
         except Exception as e:
-            print(f"分类批次 {i//batch_size + 1} 失败： {e}")
-            continue
-    
-    if not all_cls_results:
-        print(f"所有分类处理都失败了： {abs_id}")
-        return
-        
+            print(f"[{job.abs_id}] 分类批次 {index + 1} 失败： {e}")
+            return False
+        finally:
+            job.batch_done()
+
+    def metrics(self):
+        elapsed = time.monotonic() - self.started_at if self.started_at else 0.0
+        return {key: stage.metrics(elapsed) for key, stage in self.stages.items()}
+
+    def queue_depths(self):
+        return " / ".join(f"{stage.name} {stage.queue.qsize()}" for stage in self.stages.values())
+
+
+_default_pipeline = None
+_default_pipeline_lock = threading.Lock()
+
+
+def get_stream_pipeline():
+    """单独调用 process_abstract 时共用的流水线，首次使用时创建"""
+    global _default_pipeline
+    with _default_pipeline_lock:
+        if _default_pipeline is None:
+            _default_pipeline = StreamingPipeline()
+        return _default_pipeline
+
+
+def build_result(batch_entities, all_gen_results, all_cls_results):
     # 整理结果
     result = {}
     for item in batch_entities:
@@ -280,19 +506,102 @@ def process_abstract(abs_id, title, abstract, output_dir="outputs"):
             if entity not in result:
                 result[entity] = []
             result[entity].append(record)
-    
-    with open(os.path.join(output_dir, f"{abs_id}.json"), "w", encoding="utf-8") as f:
-        json.dump(result, f, ensure_ascii=False, indent=2)
+    return result
+
+
+def process_abstract(abs_id, title, abstract, output_dir="outputs"):
+    return get_stream_pipeline().submit(abs_id, title, abstract, output_dir).future.result()
         
-import time
-def run_pipeline_from_csv(csv_path, output_dir="outputs"):
-    with open(csv_path, newline='', encoding='utf-8') as csvfile:
+def _summarize(job):
+    result = job.future.result()
+    return {
+        "id": job.abs_id,
+        "ok": result is not None,
+        "entities": len(result) if result else 0,
+        "seconds": job.seconds,
+    }
+
+
+def run_pipeline_from_csv(csv_path, output_dir="outputs", concurrency=IE_CONCURRENCY, ordered=False, resume=True):
+    """
+    并发处理 CSV 中的摘要：最多 concurrency 篇同时在途（逐行读取，不一次性提交全部），
+    本次运行单独建一条流水线，抽取阶段的线程数等于 concurrency；
+    所有 LLM 请求共用 rate_limiter 的 RPM / TPM 限制。
+    ordered=True 时按 CSV 顺序输出进度与汇总，否则按完成顺序；
+    汇总逐行写入 output_dir/run_log.jsonl，结束时各阶段的利用率与排队统计写入 stage_metrics.json。
+    resume=True 时跳过已有输出文件的摘要。
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    pipeline = StreamingPipeline(extract_workers=concurrency)
+    start = time.time()
+    done = failed = skipped = 0
+    with open(csv_path, newline='', encoding='utf-8') as csvfile, \
+            open(os.path.join(output_dir, "run_log.jsonl"), "a", encoding="utf-8") as log:
         reader = csv.DictReader(csvfile)
-        for row in reader:
-            ts = time.time()
-            print(f"---------------------- 正在处理 {row['id']} ----------------------")
-            process_abstract(row["id"], row["title"], row["abstract"], output_dir)
-            print(time.time() - ts)
-            
-            
-run_pipeline_from_csv(csv_path="samples.csv")
\ No newline at end of file
+        in_flight = deque()
+
+        def report(job):
+            nonlocal done, failed
+            summary = _summarize(job)
+            done += 1
+            failed += 0 if summary["ok"] else 1
+            log.write(json.dumps(summary, ensure_ascii=False) + "\n")
+            log.flush()
+            elapsed = time.time() - start
+            print(f"---------------------- 完成 {summary['id']}（{summary['seconds']}s）"
+                  f" 已完成 {done}，失败 {failed}，{done / elapsed * 3600:.0f} 篇/小时，"
+                  f"队列 {pipeline.queue_depths()} ----------------------")
+
+        def drain(block):
+            """回收已完成的摘要；block=True 时至少等到一篇完成"""
+            if ordered:
+                # 有序模式只能按队首顺序输出
+                while in_flight and (block or in_flight[0].future.done()):
+                    report(in_flight.popleft())
+                    block = False
+            else:
+                if block:
+                    wait([job.future for job in in_flight], return_when=FIRST_COMPLETED)
+                for job in [j for j in in_flight if j.future.done()]:
+                    in_flight.remove(job)
+                    report(job)
+
+        try:
+            for row in reader:
+                if resume and os.path.exists(os.path.join(output_dir, f"{row['id']}.json")):
+                    skipped += 1
+                    continue
+                while len(in_flight) >= concurrency:
+                    drain(block=True)
+                in_flight.append(pipeline.submit(row["id"], row["title"], row["abstract"], output_dir))
+                drain(block=False)
+            while in_flight:
+                drain(block=True)
+        finally:
+            pipeline.close()
+
+    print(f"全部完成：处理 {done} 篇，失败 {failed} 篇，跳过 {skipped} 篇，用时 {time.time() - start:.1f}s")
+    metrics = pipeline.metrics()
+    with open(os.path.join(output_dir, "stage_metrics.json"), "w", encoding="utf-8") as f:
+        json.dump(metrics, f, ensure_ascii=False, indent=2)
+    for key, m in metrics.items():
+        print(f"  {pipeline.stages[key].name}: {m['workers']} 线程，处理 {m['processed']}，失败 {m['failed']}，"
+              f"利用率 {m['utilization']:.0%}，平均排队 {m['avg_wait_s']}s，最大队列 {m['max_queued']}")
+    if done:
+        bottleneck = max(metrics, key=lambda k: metrics[k]["utilization"])
+        print(f"  瓶颈阶段: {pipeline.stages[bottleneck].name}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="材料文献摘要信息抽取")
+    parser.add_argument("csv_path", nargs="?", default="samples.csv")
+    parser.add_argument("--output-dir", default="outputs")
+    parser.add_argument("--concurrency", type=int, default=IE_CONCURRENCY, help="同时处理的摘要数")
+    parser.add_argument("--ordered", action="store_true", help="按 CSV 顺序输出结果")
+    parser.add_argument("--rpm", type=int, default=IE_RPM, help="每分钟请求数上限，0 表示不限")
+    parser.add_argument("--tpm", type=int, default=IE_TPM, help="每分钟 token 数上限，0 表示不限")
+    parser.add_argument("--no-resume", action="store_true", help="不跳过已有输出的摘要")
+    args = parser.parse_args()
+
+    rate_limiter.rpm, rate_limiter.tpm = args.rpm, args.tpm
+    run_pipeline_from_csv(args.csv_path, args.output_dir, args.concurrency, args.ordered, not args.no_resume)
@@ -5,78 +5,386 @@ import os
 import subprocess
 import ast
 import re
+import shutil
+import hashlib
+import argparse
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from typing import List, Dict
 from langchain.document_loaders import DirectoryLoader, TextLoader
 from langchain.indexes import VectorstoreIndexCreator
 from langchain.embeddings import OpenAIEmbeddings
 from dotenv import load_dotenv
 import json
-from langchain_community.vectorstores import Chroma
 from langchain_community.embeddings import OpenAIEmbeddings
+from mp_embeddings import CachedEmbeddings, embedding_model_name, is_remote_backend, make_base_embeddings
+from mp_docstore import DocStore
+from mp_vector_index import FieldVectorIndex
+from mp_lexical_index import LexicalIndex
 load_dotenv()
 
 # 1. 克隆源码
 REPO_URL = "https://github.com/materialsproject/api.git"
 REPO_DIR = "./api_repo"
 
-if not os.path.exists(REPO_DIR):
-    subprocess.run(["git", "clone", REPO_URL, REPO_DIR], check=True)
-
-# 2. 静态解析：遍历 .py 源文件，收集函数签名、文档、示例
-records = []
-for root, _, files in os.walk(REPO_DIR):
-    for fname in files:
-        if not fname.endswith(".py"): continue
-        path = os.path.join(root, fname)
-        src = open(path, encoding="utf8").read()
-        tree = ast.parse(src)
-        for node in ast.walk(tree):
-            if isinstance(node, ast.FunctionDef):
-                sig = f"{node.name}{ast.get_source_segment(src, node.args)!s}"
-                doc = ast.get_docstring(node) or ""
-                # 简单用正则抽 Example 段
-                m = re.search(r"```python(.*?)```", doc, flags=re.S)
-                example = m.group(1).strip() if m else ""
-                # 参数 & 返回部分解析（粗略 demo）
-                params = [a.arg for a in node.args.args]
-                # 尝试从 docstring 提取 Returns 部分
-                returns = ""
-                m_ret = re.search(r"Returns?:?\s*([\s\S]+?)(?:Args?:|Example:|$)", doc)
-                if m_ret:
-                    returns = m_ret.group(1).strip()
-                records.append({
-                    "file": path,
-                    "func": node.name,
-                    "signature": sig,
-                    "doc": doc,
-                    "params": params,
-                    "returns": returns,
-                    "example": example
-                })
-
-# 3. 输出部分解析结果（调试可用）
-print(f"共解析 {len(records)} 个函数")
-for r in records[:3]:
-    print(r["func"], "| params:", r["params"], "returns:", r["returns"], "example:", bool(r["example"]))
-
-# 4. 写为 JSON 文件，供后续检索，并分配唯一 id
-json_docs_dir = "./mp_docstore"
-os.makedirs(json_docs_dir, exist_ok=True)
-for idx, r in enumerate(records):
-    r["id"] = idx
-    with open(os.path.join(json_docs_dir, f"fn_{idx}.json"), "w", encoding="utf8") as f:
-        json.dump(r, f, ensure_ascii=False, indent=2)
-
-# 5. 分字段构建向量索引，metadata 加 id
-doc_texts = [r["doc"] for r in records]
-param_texts = [", ".join(r["params"]) for r in records]
-return_texts = [r["returns"] for r in records]
-ids = [r["id"] for r in records]
-
-embedding = OpenAIEmbeddings(api_key=os.getenv("API_KEY"), base_url=os.getenv("BASE_URL"), model="text-embedding-3-small")
-
-doc_store = Chroma.from_texts(doc_texts, embedding, metadatas=[{"id": i} for i in ids], persist_directory="./mp_index_doc")
-param_store = Chroma.from_texts(param_texts, embedding, metadatas=[{"id": i} for i in ids], persist_directory="./mp_index_param")
-return_store = Chroma.from_texts(return_texts, embedding, metadatas=[{"id": i} for i in ids], persist_directory="./mp_index_return")
-
-print("分字段索引构建完成，可以用 doc_store/param_store/return_store 检索。")
+# 索引产物路径
+DOCSTORE_PATH = "./mp_docstore.pack"
+MANIFEST_PATH = "./mp_index_manifest.json"
+# doc/param/return 三个字段共用的向量索引目录
+INDEX_DIR = "./mp_index"
+# 函数名 / 参数名 / 签名的 BM25 倒排索引
+LEXICAL_PATH = "./mp_lexical.json"
+# 旧版本产物（每个函数一个 fn_{id}.json、按字段分开的三个索引目录），全量重建时清理
+LEGACY_DIRS = ["./mp_docstore", "./mp_index_doc", "./mp_index_param", "./mp_index_return"]
+# 嵌入后端由 MP_EMBEDDING_BACKEND 选择（openai / local / hf），切换后端会触发全量重建
+EMBEDDING_MODEL = embedding_model_name()
+# 4：签名改为完整参数表（此前的记录签名均为 "nameNone"），同时清掉旧版写入的空白字段零向量
+MANIFEST_VERSION = 4
+# Chroma 单次写入上限有限，分批 upsert（每个函数至多 3 个向量，空白字段不建向量）
+UPSERT_BATCH_SIZE = 500
+# 解析阶段的进程数，默认使用全部 CPU；每个进程任务包含的文件数
+INDEX_WORKERS = int(os.getenv("MP_INDEX_WORKERS", os.cpu_count() or 1))
+SCAN_CHUNKSIZE = 16
+# 向量写入队列最多缓存的批次数（每批约 UPSERT_BATCH_SIZE 条）
+EMBED_QUEUE_SIZE = 4
+# 嵌入缓存与并发/限速预算
+EMBEDDING_CACHE_PATH = "./mp_embedding_cache.sqlite"
+EMBED_CONCURRENCY = int(os.getenv("MP_EMBED_CONCURRENCY", 4))
+EMBED_RPM = int(os.getenv("MP_EMBED_RPM", 0)) or None
+EMBED_TPM = int(os.getenv("MP_EMBED_TPM", 0)) or None
+
+
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def make_function_id(rel_path: str, func_name: str, occurrence: int) -> str:
+    """
+    生成稳定的函数 id：由相对路径 + 函数名 + 同名出现序号决定，
+    与行号无关，文件内其它位置的改动不会导致 id 变化。
+    """
+    key = f"{rel_path}::{func_name}#{occurrence}"
+    return hashlib.sha1(key.encode("utf8")).hexdigest()[:16]
+
+
+def record_hash(record: Dict) -> str:
+    body = {k: v for k, v in record.items() if k != "id"}
+    return hashlib.sha1(json.dumps(body, ensure_ascii=False, sort_keys=True).encode("utf8")).hexdigest()
+
+
+# 2. 静态解析：解析单个 .py 源文件，收集函数签名、文档、示例
+def parse_file(path: str) -> List[Dict]:
+    rel_path = os.path.relpath(path, REPO_DIR)
+    src = open(path, encoding="utf8").read()
+    tree = ast.parse(src)
+    records = []
+    occurrences = {}
+    for node in ast.walk(tree):
+        if isinstance(node, ast.FunctionDef):
+            # ast.arguments 没有位置信息，get_source_segment 取不到参数段，直接还原完整参数表
+            sig = f"{node.name}({ast.unparse(node.args)})"
+            doc = ast.get_docstring(node) or ""
+            # 简单用正则抽 Example 段
+            m = re.search(r"```python(.*?)```", doc, flags=re.S)
+            example = m.group(1).strip() if m else ""
+            # 参数 & 返回部分解析（粗略 demo）
+            params = [a.arg for a in node.args.args]
+            # 尝试从 docstring 提取 Returns 部分
+            returns = ""
+            m_ret = re.search(r"Returns?:?\s*([\s\S]+?)(?:Args?:|Example:|$)", doc)
+            if m_ret:
+                returns = m_ret.group(1).strip()
+            occurrence = occurrences.get(node.name, 0)
+            occurrences[node.name] = occurrence + 1
+            records.append({
+                "id": make_function_id(rel_path, node.name, occurrence),
+                "file": path,
+                "func": node.name,
+                "signature": sig,
+                "doc": doc,
+                "params": params,
+                "returns": returns,
+                "example": example
+            })
+    return records
+
+
+def field_texts(record: Dict) -> Dict[str, str]:
+    """分字段构建向量索引所用的文本"""
+    return {
+        "doc": record["doc"],
+        "param": ", ".join(record["params"]),
+        "return": record["returns"],
+    }
+
+
+def load_manifest() -> Dict:
+    """
+    manifest 结构：
+    {
+      "version": 4,
+      "model": "text-embedding-3-small",
+      "files": {"相对路径": {"hash": "文件 sha256", "functions": {"函数 id": "函数记录 hash"}}}
+    }
+    """
+    if not os.path.exists(MANIFEST_PATH):
+        return {}
+    with open(MANIFEST_PATH, "r", encoding="utf8") as f:
+        manifest = json.load(f)
+    if manifest.get("version") != MANIFEST_VERSION or manifest.get("model") != EMBEDDING_MODEL:
+        print("manifest 版本或嵌入模型已变化，执行全量重建")
+        return {}
+    return manifest
+
+
+def save_manifest(manifest: Dict):
+    tmp_path = MANIFEST_PATH + ".tmp"
+    with open(tmp_path, "w", encoding="utf8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, MANIFEST_PATH)
+
+
+def iter_source_files(repo_dir: str):
+    # 排序保证遍历顺序稳定
+    for root, dirs, files in os.walk(repo_dir):
+        dirs.sort()
+        for fname in sorted(files):
+            if fname.endswith(".py"):
+                yield os.path.join(root, fname)
+
+
+def scan_file(job):
+    """
+    进程池任务：计算文件 hash，hash 未变化时跳过解析。
+    job: (文件路径, manifest 中记录的旧 hash)
+    """
+    path, known_hash = job
+    digest = file_sha256(path)
+    if digest == known_hash:
+        return path, digest, None
+    return path, digest, parse_file(path)
+
+
+def scan_chunk(jobs):
+    return [scan_file(job) for job in jobs]
+
+
+def iter_chunks(iterable, size: int):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def scan_repo(old_files: Dict, workers: int, chunksize: int = 0):
+    """
+    按文件分块扇出到进程池做 hash + AST 解析，逐个产出 (路径, hash, 记录或 None)。
+    同时在途的块数不超过 workers * 2，解析结果不会在内存中堆积；
+    按提交顺序取回结果，合并顺序与串行遍历一致，保证结果确定。
+    """
+    jobs = (
+        (path, old_files.get(os.path.relpath(path, REPO_DIR), {}).get("hash"))
+        for path in iter_source_files(REPO_DIR)
+    )
+    if workers <= 1:
+        yield from map(scan_file, jobs)
+        return
+
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for chunk in iter_chunks(jobs, chunksize or SCAN_CHUNKSIZE):
+            pending.append(pool.submit(scan_chunk, chunk))
+            if len(pending) >= workers * 2:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def diff_repo(manifest: Dict, new_files: Dict, stats: Dict, workers: int = 1, chunksize: int = 0):
+    """
+    对比 manifest 与当前源码，只重新解析 hash 变化的文件。
+    逐文件产出 (需要 upsert 的函数记录, 需要删除的函数 id)，
+    new_files 就地填充为新 manifest 的 files 部分，stats 累计计数。
+    """
+    old_files = manifest.get("files", {})
+
+    for path, digest, records in scan_repo(old_files, workers, chunksize):
+        rel_path = os.path.relpath(path, REPO_DIR)
+        old_entry = old_files.get(rel_path)
+        if records is None:
+            new_files[rel_path] = old_entry
+            continue
+
+        stats["parsed"] += 1
+        old_functions = old_entry["functions"] if old_entry else {}
+        functions = {}
+        upserts = []
+        for r in records:
+            h = record_hash(r)
+            functions[r["id"]] = h
+            if old_functions.get(r["id"]) != h:
+                upserts.append(r)
+        removed_ids = set(old_functions) - set(functions)
+        new_files[rel_path] = {"hash": digest, "functions": functions}
+        stats["upserted"] += len(upserts)
+        stats["removed"] += len(removed_ids)
+        yield upserts, removed_ids
+
+    # 已从仓库中删除的文件
+    for rel_path in set(old_files) - set(new_files):
+        removed_ids = set(old_files[rel_path]["functions"])
+        stats["removed"] += len(removed_ids)
+        yield [], removed_ids
+
+
+def write_vectors(index: FieldVectorIndex, upserts: List[Dict], removed_ids):
+    """按稳定 id 删除失效向量、upsert 变更向量，只为变更文本付出嵌入开销"""
+    index.delete(removed_ids)
+    index.upsert([(r["id"], field_texts(r)) for r in upserts])
+
+
+class VectorWriter(threading.Thread):
+    """
+    向量写入线程：从有界队列消费 (upserts, removed_ids) 批次，嵌入后写入统一向量索引。
+    解析仍在进行时嵌入就已开始；队列满时解析端阻塞，形成背压。
+    """
+
+    def __init__(self, embedding, queue_size: int = EMBED_QUEUE_SIZE):
+        super().__init__(daemon=True)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.index = FieldVectorIndex(embedding, INDEX_DIR)
+
+    def submit(self, item):
+        while True:
+            if self.error is not None:
+                raise RuntimeError("向量写入线程失败") from self.error
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def close(self):
+        self.submit(None)
+        self.join()
+        if self.error is not None:
+            raise RuntimeError("向量写入线程失败") from self.error
+
+    def run(self):
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    return
+                write_vectors(self.index, *item)
+        except Exception as e:
+            self.error = e
+
+
+def main():
+    parser = argparse.ArgumentParser(description="解析 Materials Project API 源码并构建分字段向量索引")
+    parser.add_argument("--full", action="store_true", help="忽略 manifest，全量重建索引")
+    parser.add_argument("--workers", type=int, default=INDEX_WORKERS, help="AST 解析进程数，1 表示串行")
+    parser.add_argument("--chunksize", type=int, default=SCAN_CHUNKSIZE, help="每个进程任务包含的文件数")
+    parser.add_argument("--quantize", choices=["float16", "int8"], help="建完索引后额外导出量化副本（见 mp_quantized_index.py），降低检索进程内存，磁盘上是额外占用")
+    args = parser.parse_args()
+
+    if not os.path.exists(REPO_DIR):
+        subprocess.run(["git", "clone", REPO_URL, REPO_DIR], check=True)
+
+    manifest = {} if args.full else load_manifest()
+    if not manifest:
+        # 全量重建：清理旧产物，避免残留无主向量
+        for path in [INDEX_DIR, *LEGACY_DIRS]:
+            shutil.rmtree(path, ignore_errors=True)
+        for path in [DOCSTORE_PATH, DocStore(DOCSTORE_PATH).index_path, LEXICAL_PATH]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    embedding = make_base_embeddings()
+    if is_remote_backend():
+        # 远程后端才需要磁盘缓存与限速
+        embedding = CachedEmbeddings(
+            embedding,
+            model=EMBEDDING_MODEL,
+            cache_path=EMBEDDING_CACHE_PATH,
+            max_concurrency=EMBED_CONCURRENCY,
+            rpm=EMBED_RPM,
+            tpm=EMBED_TPM,
+        )
+    docstore = DocStore(DOCSTORE_PATH)
+    lexical = LexicalIndex.load(LEXICAL_PATH)
+    writer = VectorWriter(embedding)
+    writer.start()
+
+    # 流式处理：解析 -> 写 docstore -> 攒批 -> 交给向量写入线程
+    new_files = {}
+    stats = {"parsed": 0, "upserted": 0, "removed": 0}
+    batch, batch_removed = [], set()
+    param_names = set()
+    for upserts, removed_ids in diff_repo(manifest, new_files, stats, args.workers, args.chunksize):
+        param_names.update(p for r in upserts for p in r["params"])
+        # 3. 输出部分解析结果（调试可用）
+        for r in upserts[:max(0, 3 - (stats["upserted"] - len(upserts)))]:
+            print(r["func"], "| params:", r["params"], "returns:", r["returns"], "example:", bool(r["example"]))
+
+        # 4. 写入打包 docstore 与词面倒排索引，供后续按 id / 参数名检索
+        docstore.write(upserts, removed_ids)
+        lexical.update(upserts, removed_ids)
+
+        # 5. 分字段增量更新向量索引，metadata 加 id
+        batch.extend(upserts)
+        batch_removed.update(removed_ids)
+        if len(batch) + len(batch_removed) >= UPSERT_BATCH_SIZE:
+            writer.submit((batch, batch_removed))
+            batch, batch_removed = [], set()
+    if batch or batch_removed:
+        writer.submit((batch, batch_removed))
+    writer.close()
+    # 预先嵌入所有参数名，检索端按参数名查询时直接命中缓存
+    if is_remote_backend() and param_names:
+        embedding.embed_documents(sorted(param_names))
+    docstore.flush()
+    docstore.close()
+    lexical.save()
+
+    print(f"重新解析 {stats['parsed']} 个文件，变更函数 {stats['upserted']} 个，删除函数 {stats['removed']} 个")
+    print("嵌入统计:", getattr(embedding, "stats", EMBEDDING_MODEL))
+
+    # 向量库更新成功后再落盘 manifest，中途失败下次会重新处理
+    # 内容不变时不重写，manifest 的修改时间用于判断量化副本是否过期
+    new_manifest = {"version": MANIFEST_VERSION, "model": EMBEDDING_MODEL, "files": new_files}
+    if new_manifest != manifest:
+        save_manifest(new_manifest)
+    import mp_quantized_index
+    quantized_dir = mp_quantized_index.DEFAULT_QUANTIZED_DIR
+    meta_path = os.path.join(quantized_dir, "meta.json")
+    if args.quantize:
+        mp_quantized_index.build(embedding, args.quantize, index_dir=INDEX_DIR)
+    elif os.path.exists(meta_path) and os.path.getmtime(MANIFEST_PATH) > os.path.getmtime(meta_path):
+        # 已有量化副本比 manifest 旧：按原模式重新导出，避免 MP_VECTOR_STORE=quantized 读到过期向量
+        mp_quantized_index.build(
+            embedding,
+            mp_quantized_index.read_meta(quantized_dir)["mode"],
+            index_dir=INDEX_DIR,
+            keep_full=os.path.exists(os.path.join(quantized_dir, "full.npy")),
+        )
+    if not stats["upserted"] and not stats["removed"]:
+        print("索引已是最新，无需更新。")
+    else:
+        print("分字段索引构建完成，可以用 FieldVectorIndex 按字段检索。")
+
+
+if __name__ == "__main__":
+    main()
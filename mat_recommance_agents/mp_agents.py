@@ -5,19 +5,32 @@
 import os
 import json
 import asyncio
+import argparse
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from functools import cached_property
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from dotenv import load_dotenv
-import re
 
 # --- AutoGen and Agents ---
-from autogen import AssistantAgent, ConversableAgent, GroupChat, GroupChatManager, UserProxyAgent
+from autogen import AssistantAgent, ConversableAgent, GroupChat, GroupChatManager
 from autogen_core.tools import FunctionTool
 
 # --- LangChain for Retrieval ---
-from langchain.vectorstores import Chroma
-from langchain.embeddings import OpenAIEmbeddings
+from mp_docstore import DocStore
+from mp_vector_index import FieldVectorIndex
+from mp_lexical_index import LexicalIndex
+from mp_retrieval_cache import IntentCache, normalize_intent
+from mp_embeddings import CachedEmbeddings, embedding_model_name, estimate_tokens, is_remote_backend, make_base_embeddings
+from mp_pipeline_engine import PipelineEngine, Stage, record_tokens
+from mp_structured_output import StructuredOutputError, parse_structured, structured_llm_config
+from mp_query_templates import QueryTemplateCache
+from warm_executor import WarmCodeExecutor
+from mp_code_validator import SignatureIndex, validate_code
 
 # --- Code Execution Tools ---
-from autogen.code_utils import create_virtual_env
+from autogen.code_utils import create_virtual_env, extract_code
 from autogen.coding import CodeBlock, LocalCommandLineCodeExecutor
 
 # 1. Load environment variables
@@ -35,81 +48,112 @@ llm_config = {
     "cache_seed": 12,
 }
 
-# 3. Set up code execution environment for final step
-venv_dir = os.path.expanduser("~/llm_env")
-venv_context = create_virtual_env(venv_dir)
-executor = LocalCommandLineCodeExecutor(
-    virtual_env_context=venv_context,
-    timeout=200,
-    work_dir="coding"
-)
-
-# 4. Knowledge retrieval setup (Chroma index built earlier in './mp_index')
-doc_store = Chroma(persist_directory="./mp_index_doc",
-                  embedding_function=OpenAIEmbeddings(api_key=API_KEY,base_url=BASE_URL, model="text-embedding-3-small"))
-param_store = Chroma(persist_directory="./mp_index_param",
-                    embedding_function=OpenAIEmbeddings(api_key=API_KEY,base_url=BASE_URL, model="text-embedding-3-small"))
-return_store = Chroma(persist_directory="./mp_index_return",
-                     embedding_function=OpenAIEmbeddings(api_key=API_KEY,base_url=BASE_URL, model="text-embedding-3-small"))
-
-# 5. Define retrieval tool for MP index
+# 3. Code execution environment (created lazily by MPQueryPipeline.executor)
+VENV_DIR = os.path.expanduser("~/llm_env")
+CODING_WORK_DIR = "coding"
+# 常驻预热的执行进程池（预先导入 numpy / mp_api 等），设为 0 时退回每个代码块启动新解释器
+WARM_EXECUTOR = os.getenv("MP_WARM_EXECUTOR", "1") == "1"
+WARM_EXECUTOR_SIZE = int(os.getenv("MP_WARM_EXECUTOR_SIZE", 2))
+# 参数化查询模板：执行成功的生成代码存为模板，同类意图直接填参运行，不再调用 CodeWriter（开启时也会执行代码）
+QUERY_TEMPLATES = os.getenv("MP_QUERY_TEMPLATES", "0") == "1"
+QUERY_TEMPLATE_PATH = "./mp_query_templates.json"
+# 本地列存储（"local" 数据源）：被已同步且未过期的覆盖范围完整覆盖的意图直接在进程内回答
+LOCAL_STORE = os.getenv("MP_LOCAL_STORE", "0") == "1"
+LOCAL_STORE_DIR = "./mp_local_store"
+LOCAL_MAX_AGE = float(os.getenv("MP_LOCAL_MAX_AGE", 7 * 24 * 3600))
+# 投机生成：同时生成 N 份候选代码（不同温度 / 示例顺序）并行执行，取第一个得到有效 output 的，其余取消
+# （需要常驻执行进程池来做超时与取消，开启时忽略 MP_WARM_EXECUTOR=0）
+SPECULATIVE_CANDIDATES = int(os.getenv("MP_SPECULATIVE_CANDIDATES", 0))
+SPECULATIVE_TIMEOUT = float(os.getenv("MP_SPECULATIVE_TIMEOUT", 120))
+# 执行前用索引中的函数签名静态校验生成代码，不合格的不执行，并把错误反馈给 CodeWriter 重写一次
+VALIDATE_CODE = os.getenv("MP_VALIDATE_CODE", "1") == "1"
+VALIDATION_EXIT_CODE = 2
+# 是否在流程末尾执行生成的代码
+EXECUTE_CODE = QUERY_TEMPLATES or SPECULATIVE_CANDIDATES > 1 or os.getenv("MP_EXECUTE_CODE", "0") == "1"
+# 附加在生成代码末尾：未给 output 赋值视为执行失败
+OUTPUT_CHECK = """
+try:
+    output
+except NameError:
+    raise SystemExit("生成的代码没有给 output 变量赋值")
+if output is None:
+    raise SystemExit("output 为 None")
+"""
 
-def retrieve_snippets(intent: dict) -> list:
+# 4. Knowledge retrieval setup (unified multi-field Chroma index built earlier in './mp_index')
+# 嵌入后端需与建索引时一致，由 MP_EMBEDDING_BACKEND 选择（local 可完全离线检索）
+# MP_VECTOR_STORE=quantized 时改用 mp_quantized_index 导出的量化副本（./mp_index_q），内存占用更小
+USE_QUANTIZED_INDEX = os.getenv("MP_VECTOR_STORE", "chroma") == "quantized"
+INDEX_DIR = "./mp_index"
+QUANTIZED_INDEX_DIR = "./mp_index_q"
+DOCSTORE_PATH = "./mp_docstore.pack"
+LEXICAL_PATH = "./mp_lexical.json"
+MANIFEST_PATH = "./mp_index_manifest.json"
+# 意图级结果缓存容量与过期时间
+INTENT_CACHE_SIZE = int(os.getenv("MP_INTENT_CACHE_SIZE", 1024))
+INTENT_CACHE_TTL = float(os.getenv("MP_INTENT_CACHE_TTL", 3600))
+# 并发检索模式：每个 doc/param/return 查询独立做带字段过滤检索，在线程池中同时发出
+RETRIEVAL_CONCURRENT = os.getenv("MP_RETRIEVAL_CONCURRENT", "0") == "1"
+RETRIEVAL_WORKERS = int(os.getenv("MP_RETRIEVAL_WORKERS", 8))
+# 同时在途的查询数上限（异步流程引擎的全局并发限制）
+PIPELINE_CONCURRENCY = int(os.getenv("MP_PIPELINE_CONCURRENCY", 4))
+# 融合模式：一次调用同时完成需求澄清、意图解析与数据源选择，需求含糊时退回多智能体流程
+FUSED_INTENT = os.getenv("MP_FUSED_INTENT", "0") == "1"
+DATASOURCES = ("mp", "local", "cif")
+# 服务端 JSON-schema 输出（response_format），仅 OpenAI 兼容且支持该参数的服务可开启；
+# 关闭时在本地做容错解析 + 校验，不合格只发一次字段级修复请求
+JSON_SCHEMA_OUTPUT = os.getenv("MP_JSON_SCHEMA_OUTPUT", "0") == "1"
+
+# 5. Retrieval ranking
+
+# 融合后最多返回的函数数、检索结果注入 CodeWriter 提示词的 token 预算
+RETRIEVAL_TOP_K = int(os.getenv("MP_RETRIEVAL_TOP_K", 3))
+SNIPPET_TOKEN_BUDGET = int(os.getenv("MP_SNIPPET_TOKEN_BUDGET", 1500))
+# 倒数排名融合 (RRF) 的平滑常数；词面 BM25 整体排名在融合中的权重
+RRF_K = 60
+LEXICAL_WEIGHT = float(os.getenv("MP_LEXICAL_WEIGHT", 1.0))
+
+
+def fuse_hits(ranked_lists, weights=None) -> list:
     """
-    根据结构化意图，从本地 MP 知识库检索相关示例代码。
-    intent: dict, 包含字段如 'target', 'filters', 'fields' 等。
-    分字段分别检索 docstring、params、returns，统计每个 id 命中次数，返回命中次数最多的完整函数文档。
+    倒数排名融合：每路结果（已按相关性从高到低排序）的第 r 名贡献 weight / (RRF_K + r)，
+    向量距离与 BM25 分数量纲不同，只用名次融合。按总分降序、id 升序返回 [(id, 分数)]
     """
-    import os
-    id_counter = {}
-    query = intent.get("query", "")
-    params = intent.get("filters", {}).keys()
-    fields = intent.get("fields", [])
-
-    # 1. docstring 检索
-    doc_results = doc_store.similarity_search_with_score(query, k=3) if query else []
-    for d, _ in doc_results:
-        idx = d.metadata.get("id")
-        if idx is not None:
-            id_counter[idx] = id_counter.get(idx, 0) + 1
-
-    # 2. params 检索
-    for p in params:
-        if p:
-            param_results = param_store.similarity_search_with_score(p, k=2)
-            for d, _ in param_results:
-                idx = d.metadata.get("id")
-                if idx is not None:
-                    id_counter[idx] = id_counter.get(idx, 0) + 1
-
-    # 3. returns 检索
-    for f in fields:
-        if f:
-            return_results = return_store.similarity_search_with_score(f, k=2)
-            for d, _ in return_results:
-                idx = d.metadata.get("id")
-                if idx is not None:
-                    id_counter[idx] = id_counter.get(idx, 0) + 1
-
-    # 4. 选出命中次数最多的函数
-    if not id_counter:
-        return []
-    max_count = max(id_counter.values())
-    best_ids = [idx for idx, cnt in id_counter.items() if cnt == max_count]
-
-    # 5. 加载完整函数文档
-    results = []
-    for idx in best_ids:
-        json_path = os.path.join("./mp_docstore", f"fn_{idx}.json")
-        with open(json_path, "r", encoding="utf8") as f:
-            results.append(json.load(f))
-    return results
+    scores = {}
+    for i, hits in enumerate(ranked_lists):
+        weight = weights[i] if weights else 1.0
+        for rank, (idx, _) in enumerate(hits, start=1):
+            scores[idx] = scores.get(idx, 0.0) + weight / (RRF_K + rank)
+    return sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+
+
+def project_snippet(record: dict) -> dict:
+    """只保留写代码需要的部分：签名、参数、示例和文档首行，丢弃完整 docstring"""
+    doc = record.get("doc", "").strip()
+    return {
+        "func": record["func"],
+        "signature": record["signature"],
+        "params": record["params"],
+        "summary": doc.splitlines()[0] if doc else "",
+        "example": record.get("example", ""),
+    }
+
+
+def fit_token_budget(snippets: list, budget: int) -> list:
+    """按排名依次放入片段直到超出预算；第一条始终保留（超长时截断示例）"""
+    kept, used = [], 0
+    for snippet in snippets:
+        cost = estimate_tokens(json.dumps(snippet, ensure_ascii=False))
+        if kept and used + cost > budget:
+            break
+        if not kept and cost > budget and snippet["example"]:
+            overflow_chars = (cost - budget) * 4
+            snippet = {**snippet, "example": snippet["example"][:max(0, len(snippet["example"]) - overflow_chars)]}
+            cost = budget
+        kept.append(snippet)
+        used += cost
+    return kept
 
-retriever_tool = FunctionTool(
-    func=retrieve_snippets,
-    name="mp_retriever",
-    description="检索 Materials Project API 调用示例"
-)
 
 # 6. System messages for each agent
 requirement_clarification = """
@@ -177,121 +221,769 @@ code_writer_prompt = """
 请严格按照以下要求：
 1. 输出结果赋值给 `output` 变量。
 2. 代码必须包含注释，解释关键步骤。
+3. 直接使用 `MPRester()`，不要传入或定义 API Key，密钥由执行环境的 MP_API_KEY 环境变量提供。
 
 示例格式：
 ```python
 from mp_api.client import MPRester
-with MPRester(API_KEY) as mpr:
+with MPRester() as mpr:
     docs = mpr.materials.summary.search(...)
     output = [doc.__dict__ for doc in docs]
 ```"""
 
-# 7. Instantiate agents
+fused_intent_prompt = """
+你是材料数据查询的意图解析专家，一次性完成需求澄清、意图解析和数据源选择。
+
+【输出要求】
+- 只输出一个 JSON 对象，不要输出任何多余的自然语言解释或代码块标记。
+- 字段严格为：target（字符串）、filters（对象）、fields（字符串数组）、datasource（"mp"、"local"、"cif" 之一）、ambiguous（布尔值）。
+- 需求缺少查询对象、条件含义不明确或存在多种理解时，ambiguous 为 true，其余字段尽量填写。
+
+【示例输出】
+{
+  "target": "materials",
+  "filters": {
+    "elements": ["Si", "O"],
+    "band_gap": { "min": 1.0 }
+  },
+  "fields": ["material_id", "band_gap"],
+  "datasource": "mp",
+  "ambiguous": false
+}
+"""
+
+# 意图解析与融合模式输出的 JSON 结构
+INTENT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "datasource": {"type": "string"},
+        "target": {"type": "string"},
+        "filters": {"type": "object"},
+        "fields": {"type": "array", "items": {"type": "string"}},
+    },
+    "required": ["target", "filters", "fields"],
+}
+
+FUSED_INTENT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "target": {"type": "string"},
+        "filters": {"type": "object"},
+        "fields": {"type": "array", "items": {"type": "string"}},
+        "datasource": {"type": "string", "enum": list(DATASOURCES)},
+        "ambiguous": {"type": "boolean"},
+    },
+    "required": ["target", "filters", "fields", "datasource", "ambiguous"],
+}
+
+# 7. Query pipeline
+
+def check_fused_intent(data) -> str:
+    """融合模式输出已通过 schema 校验后的语义检查，返回空字符串表示可直接使用，否则返回退回多智能体流程的原因"""
+    if data["ambiguous"]:
+        return "需求含糊"
+    if not data["target"].strip():
+        return "缺少 target"
+    if not data["filters"] and not data["fields"]:
+        return "filters 与 fields 均为空"
+    return ""
 
-requirement_agent = AssistantAgent(
-    name="RequirementClarifier",
-    llm_config=llm_config,
-    system_message=requirement_clarification,
-    human_input_mode="ALWAYS"
-)
-intent_agent = AssistantAgent(
-    name="IntentParser",
-    llm_config=llm_config,
-    system_message=query_intent_conversion,
-    human_input_mode="NEVER"
-)
-source_agent = AssistantAgent(
-    name="SourceSelector",
-    llm_config=llm_config,
-    system_message=data_source_selection,
-    human_input_mode="NEVER"
-)
-retriever_agent = AssistantAgent(
-    name="MPRetriever",
-    llm_config=llm_config,
-    human_input_mode="NEVER"
-)
 
-code_writer_agent = AssistantAgent(
-    name="CodeWriter",
-    llm_config=llm_config,
-    system_message=code_writer_prompt,
-    code_execution_config={"use_docker": False},
-    human_input_mode="NEVER"
+def agent_reply(agent: ConversableAgent, content: str, history: list = ()) -> str:
+    """
+    单轮调用 agent（history 为此前的对话消息），
+    并把估算的 token 数（系统提示 + 全部输入 / 输出）计入当前流程阶段
+    """
+    messages = list(history) + [{"role": "user", "content": content}]
+    reply = agent.generate_reply(messages)
+    if isinstance(reply, dict):
+        reply = reply.get("content") or ""
+    reply = reply or ""
+    prompt = agent.system_message + "".join(m["content"] for m in messages)
+    record_tokens(estimate_tokens(prompt), estimate_tokens(reply))
+    return reply
+
+
+def agent_json(agent: ConversableAgent, content: str, schema: dict) -> dict:
+    """调用 agent 并按 schema 解析回复；不合格时在同一对话中追加一次修复请求"""
+    reply = agent_reply(agent, content)
+    history = [{"role": "user", "content": content}, {"role": "assistant", "content": reply}]
+    return parse_structured(reply, schema, ask=lambda repair: agent_reply(agent, repair, history))
+
+
+def extract_python(reply: str) -> str:
+    """取回复中的第一个 python 代码块；没有代码块标记时整段视为代码（模板填参的结果即如此）"""
+    blocks = extract_code(reply)
+    for lang, code in blocks:
+        if lang in ("python", "py"):
+            return code
+    return blocks[0][1] if blocks else reply
+
+
+def agent_llm_config(name: str, schema: dict) -> dict:
+    return structured_llm_config(llm_config, name, schema) if JSON_SCHEMA_OUTPUT else llm_config
+
+
+class MPQueryPipeline:
+    """
+    MP 查询流程：RequirementClarifier -> IntentParser -> SourceSelector -> 检索 -> CodeWriter。
+
+    虚拟环境、代码执行器、向量索引 / docstore / 倒排索引和各个 agent 都在首次使用时才创建，
+    且每个进程只创建一次；同一个实例可以连续处理任意多个问题。
+    interactive=False 时需求澄清不再等待终端输入，适用于 HTTP 服务。
+    fused=True 时先用一次调用同时得到意图与数据源，只有需求含糊或输出不合格时才走三个 agent 的原流程。
+    """
+
+    def __init__(self, interactive: bool = True, verbose: bool = True, fused: bool = None):
+        self.interactive = interactive
+        self.verbose = verbose
+        self.fused = FUSED_INTENT if fused is None else fused
+        self._index_lock = threading.Lock()
+        self._route_lock = threading.Lock()
+        self._route_stats = {"fused": 0, "fallback": 0}
+
+    # ---------- 懒加载资源 ----------
+    @cached_property
+    def executor(self):
+        venv_context = create_virtual_env(VENV_DIR)
+        # 投机执行依赖常驻进程池实现超时与取消落选候选，LocalCommandLineCodeExecutor 两者都不支持
+        if not WARM_EXECUTOR and SPECULATIVE_CANDIDATES > 1:
+            print("MP_SPECULATIVE_CANDIDATES > 1 需要常驻执行进程池，已忽略 MP_WARM_EXECUTOR=0")
+        if WARM_EXECUTOR or SPECULATIVE_CANDIDATES > 1:
+            return WarmCodeExecutor(
+                virtual_env_context=venv_context,
+                timeout=200,
+                work_dir=CODING_WORK_DIR,
+                pool_size=max(WARM_EXECUTOR_SIZE, SPECULATIVE_CANDIDATES),
+            )
+        return LocalCommandLineCodeExecutor(
+            virtual_env_context=venv_context,
+            timeout=200,
+            work_dir=CODING_WORK_DIR
+        )
+
+    @cached_property
+    def template_cache(self) -> QueryTemplateCache:
+        return QueryTemplateCache(QUERY_TEMPLATE_PATH)
+
+    @cached_property
+    def local_store(self):
+        from mp_local_store import LocalPropertyStore
+        return LocalPropertyStore(LOCAL_STORE_DIR, max_age=LOCAL_MAX_AGE)
+
+    @cached_property
+    def query_embedding(self):
+        # 远程嵌入后端的查询向量走 LRU + 磁盘缓存（与建索引共用，已预先嵌入全部参数名），常见词汇无需再请求
+        embedding = make_base_embeddings()
+        if is_remote_backend():
+            embedding = CachedEmbeddings(embedding, model=embedding_model_name(), memory_size=4096)
+        return embedding
+
+    @cached_property
+    def fn_index(self):
+        return self._open_fn_index()
+
+    def _open_fn_index(self):
+        if USE_QUANTIZED_INDEX:
+            from mp_quantized_index import QuantizedFieldIndex, StaleQuantizedIndexError
+            try:
+                return QuantizedFieldIndex(self.query_embedding, index_dir=QUANTIZED_INDEX_DIR, manifest_path=MANIFEST_PATH)
+            except StaleQuantizedIndexError as e:
+                # 副本可能还包含已删除的函数，退回 Chroma 索引
+                print(f"{e}，本次改用 Chroma 索引")
+        return FieldVectorIndex(self.query_embedding, persist_directory=INDEX_DIR)
+
+    @cached_property
+    def docstore(self) -> DocStore:
+        # 打包 docstore，按 id 直接定位函数记录
+        return DocStore(DOCSTORE_PATH)
+
+    @cached_property
+    def lexical_index(self) -> LexicalIndex:
+        # 函数名 / 参数名 / 签名的 BM25 倒排索引，过滤键逐字命中参数名时无需嵌入
+        return LexicalIndex.load(LEXICAL_PATH)
+
+    @cached_property
+    def signature_index(self) -> SignatureIndex:
+        # 代码校验用的签名表，由 docstore 中的全部函数记录构建
+        return SignatureIndex.from_docstore(self.docstore)
+
+    @cached_property
+    def intent_cache(self) -> IntentCache:
+        # 意图级结果缓存：相同（归一化后）意图直接返回上次结果，manifest 变化时自动失效
+        return IntentCache(
+            maxsize=INTENT_CACHE_SIZE,
+            ttl=INTENT_CACHE_TTL,
+            manifest_path=MANIFEST_PATH,
+            on_invalidate=self.reopen_index,
+        )
+
+    @cached_property
+    def retrieval_pool(self) -> ThreadPoolExecutor:
+        return ThreadPoolExecutor(max_workers=RETRIEVAL_WORKERS)
+
+    @cached_property
+    def requirement_agent(self) -> AssistantAgent:
+        return AssistantAgent(
+            name="RequirementClarifier",
+            llm_config=llm_config,
+            system_message=requirement_clarification,
+            human_input_mode="ALWAYS" if self.interactive else "NEVER"
+        )
+
+    @cached_property
+    def intent_agent(self) -> AssistantAgent:
+        return AssistantAgent(
+            name="IntentParser",
+            llm_config=agent_llm_config("query_intent", INTENT_SCHEMA),
+            system_message=query_intent_conversion,
+            human_input_mode="NEVER"
+        )
+
+    @cached_property
+    def source_agent(self) -> AssistantAgent:
+        return AssistantAgent(
+            name="SourceSelector",
+            llm_config=llm_config,
+            system_message=data_source_selection,
+            human_input_mode="NEVER"
+        )
+
+    @cached_property
+    def fused_intent_agent(self) -> AssistantAgent:
+        return AssistantAgent(
+            name="FusedIntentParser",
+            llm_config=agent_llm_config("fused_intent", FUSED_INTENT_SCHEMA),
+            system_message=fused_intent_prompt,
+            human_input_mode="NEVER"
+        )
+
+    @cached_property
+    def code_writer_agent(self) -> AssistantAgent:
+        return AssistantAgent(
+            name="CodeWriter",
+            llm_config=llm_config,
+            system_message=code_writer_prompt,
+            code_execution_config={"use_docker": False},
+            human_input_mode="NEVER"
+        )
+
+    @cached_property
+    def code_writer_candidates(self) -> list:
+        """投机生成用的 CodeWriter：第 0 个即 code_writer_agent，其余逐个提高温度，cache_seed 各不相同"""
+        agents = [self.code_writer_agent]
+        for i in range(1, SPECULATIVE_CANDIDATES):
+            agents.append(AssistantAgent(
+                name=f"CodeWriter{i}",
+                llm_config={**llm_config, "temperature": min(1.0, llm_config["temperature"] + 0.35 * i),
+                            "cache_seed": llm_config["cache_seed"] + i},
+                system_message=code_writer_prompt,
+                code_execution_config={"use_docker": False},
+                human_input_mode="NEVER"
+            ))
+        return agents
+
+    @cached_property
+    def engine(self) -> PipelineEngine:
+        # 数据源选择与检索都只依赖意图，由引擎并发执行
+        if self.fused:
+            # 融合模式：route 阶段一次调用得到意图与数据源，含糊时在阶段内退回澄清 + 意图解析
+            head = [
+                Stage("route", self._route, ["question"]),
+                Stage("intent", lambda route: route["intent"], ["route"]),
+                Stage("source", self._routed_source, ["route", "intent"]),
+            ]
+        else:
+            head = [
+                Stage("clarified_req", self._clarify, ["question"]),
+                Stage("intent", self._parse_intent, ["clarified_req"]),
+                Stage("source", self._select_source, ["intent"]),
+            ]
+        return PipelineEngine(
+            head + [
+                Stage("local", self._answer_local, ["intent"]),
+                Stage("template", self._lookup_template, ["intent", "local"]),
+                Stage("snippets", self._retrieve_unless_template, ["intent", "template", "local"]),
+                Stage("code", self._write_code, ["intent", "snippets", "template", "local"]),
+            ] + ([Stage("result", self._execute, ["intent", "code", "template", "local", "snippets"])] if EXECUTE_CODE else []),
+            initial_inputs=["question"],
+            max_concurrency=PIPELINE_CONCURRENCY,
+        )
+
+    def warm_up(self):
+        """服务模式启动时一次性创建全部资源，避免并发请求各自触发初始化"""
+        names = ["query_embedding", "fn_index", "docstore", "lexical_index", "intent_cache",
+                 "retrieval_pool", "requirement_agent", "intent_agent", "source_agent", "code_writer_agent"]
+        if self.fused:
+            names.append("fused_intent_agent")
+        if EXECUTE_CODE:
+            names.append("executor")
+        if QUERY_TEMPLATES:
+            names.append("template_cache")
+        if SPECULATIVE_CANDIDATES > 1:
+            names.append("code_writer_candidates")
+        if LOCAL_STORE:
+            names.append("local_store")
+        for name in names:
+            getattr(self, name)
+
+    def reopen_index(self):
+        """
+        索引重建后在锁外构建新的 docstore、倒排索引、签名表（及量化副本），再在锁内整体替换。
+        旧实例不主动关闭：其他线程可能仍在用它读取，等不再被引用时由垃圾回收释放。
+        进程内的 Chroma 客户端会缓存段数据，读不到其他进程的写入（--full 重建时目录还会被删除），
+        使用 Chroma 索引时重建后需要重启服务。
+        """
+        docstore = DocStore(DOCSTORE_PATH).open()
+        fresh = {
+            "docstore": docstore,
+            "lexical_index": LexicalIndex.load(LEXICAL_PATH),
+            "signature_index": SignatureIndex.from_docstore(docstore),
+        }
+        if USE_QUANTIZED_INDEX:
+            fresh["fn_index"] = self._open_fn_index()
+        with self._index_lock:
+            self.__dict__.update(fresh)
+            fn_index = self.__dict__.get("fn_index")
+        if fn_index is None or isinstance(fn_index, FieldVectorIndex):
+            print("索引已重建：docstore 与倒排索引已重新加载，Chroma 向量索引需重启服务后才能读到新数据")
+
+    def stats(self) -> dict:
+        info = {"intent_cache": self.intent_cache.info(), "pipeline": self.engine.stats()}
+        if QUERY_TEMPLATES:
+            info["query_templates"] = self.template_cache.info()
+        if LOCAL_STORE:
+            info["local_store"] = self.local_store.info()
+        if "executor" in self.__dict__ and isinstance(self.executor, WarmCodeExecutor):
+            info["executor"] = self.executor.pool.info()
+        if self.fused:
+            with self._route_lock:
+                info["routing"] = dict(self._route_stats)
+        if isinstance(self.query_embedding, CachedEmbeddings):
+            info["query_embedding"] = dict(self.query_embedding.stats)
+        return info
+
+    # ---------- 检索 ----------
+    def retrieve_snippets(self, intent: dict, concurrent: bool = None, top_k: int = None, token_budget: int = None) -> list:
+        """
+        根据结构化意图，从本地 MP 知识库检索相关示例代码。
+        intent: dict, 包含字段如 'target', 'filters', 'fields' 等。
+        concurrent: 是否使用并发检索模式，默认取 MP_RETRIEVAL_CONCURRENT。
+        top_k / token_budget: 返回片段数与总 token 上限，默认取 MP_RETRIEVAL_TOP_K / MP_SNIPPET_TOKEN_BUDGET。
+        过滤键逐字命中参数名时走词面倒排索引，其余在统一向量索引上分字段检索 docstring、params、returns，
+        再与 BM25 整体排名一起做排名融合，返回排名前 top_k 的函数的精简片段（签名、参数、示例）。
+        """
+        if concurrent is None:
+            concurrent = RETRIEVAL_CONCURRENT
+        top_k = RETRIEVAL_TOP_K if top_k is None else top_k
+        token_budget = SNIPPET_TOKEN_BUDGET if token_budget is None else token_budget
+        cache_key = f"{normalize_intent(intent)}|{top_k}|{token_budget}"
+        cached = self.intent_cache.get(cache_key)
+        if cached is not None:
+            return list(cached)
+
+        with self._index_lock:
+            fn_index, docstore, lexical_index = self.fn_index, self.docstore, self.lexical_index
+
+        query = intent.get("query", "")
+        params = intent.get("filters", {}).keys()
+        fields = intent.get("fields", [])
+
+        # 1. docstring 检索；2. params 检索；3. returns 检索
+        queries = []
+        if query:
+            queries.append(("doc", query, 3))
+        queries += [("param", p, 2) for p in params if p]
+        queries += [("return", f, 2) for f in fields if f]
+
+        # 词面快路径：过滤键逐字等于某些函数的参数名时，直接用倒排表结果，不做嵌入
+        ranked_lists = []
+        vector_queries = []
+        for field, text, k in queries:
+            if field == "param" and lexical_index.has_param(text):
+                ranked_lists.append(lexical_index.search_param(text, k))
+            else:
+                vector_queries.append((field, text, k))
+
+        if concurrent:
+            # 全部查询文本先一次批量嵌入（命中缓存的不发请求），
+            # 再把剩余的检索同时发出，耗时取决于最慢的一个；完成一个合并一个
+            vectors = fn_index.embedding.embed_documents([text for _, text, _ in vector_queries]) if vector_queries else []
+            futures = [
+                self.retrieval_pool.submit(fn_index.search_vector, field, vector, k)
+                for (field, _, k), vector in zip(vector_queries, vectors)
+            ]
+            ranked_lists += [future.result() for future in as_completed(futures)]
+        else:
+            # 所有查询文本一次批量嵌入，在统一索引上一次近邻查询完成
+            ranked_lists += fn_index.search(vector_queries)
+        weights = [1.0] * len(ranked_lists)
+
+        # 混合排名：全部查询词在签名/参数上的 BM25 整体排名作为额外一路参与融合
+        lexical_hits = lexical_index.search(" ".join(text for _, text, _ in queries), max(top_k * 3, 5))
+        if lexical_hits:
+            ranked_lists.append(lexical_hits)
+            weights.append(LEXICAL_WEIGHT)
+
+        # 4. 排名融合，取前 top_k 个函数
+        best_ids = [idx for idx, _ in fuse_hits(ranked_lists, weights)[:top_k]]
+
+        # 5. 批量加载函数文档，投影为精简片段并按 token 预算截断
+        results = fit_token_budget([project_snippet(r) for r in docstore.get_many(best_ids)], token_budget)
+        self.intent_cache.put(cache_key, results)
+        return list(results)
+
+    # ---------- 完整流程 ----------
+    def _log(self, title: str, content):
+        if self.verbose:
+            print(f"-------------------------------- {title} --------------------------------")
+            print(content)
+
+    def _clarify(self, question: str) -> str:
+        clarified_req = agent_reply(self.requirement_agent, question)
+        self._log("clarified_req", clarified_req)
+        return clarified_req
+
+    def _parse_intent(self, clarified_req: str) -> dict:
+        intent = agent_json(self.intent_agent, clarified_req, INTENT_SCHEMA)
+        self._log("intent", intent)
+        return intent
+
+    def _select_source(self, intent: dict) -> str:
+        source = agent_reply(self.source_agent, json.dumps(intent, ensure_ascii=False))
+        self._log("source", source)
+        return source
+
+    def _route(self, question: str) -> dict:
+        """融合模式：一次调用得到 {target, filters, fields, datasource}；不合格时退回澄清 + 意图解析"""
+        try:
+            data = agent_json(self.fused_intent_agent, question, FUSED_INTENT_SCHEMA)
+            self._log("fused_intent", data)
+            reason = check_fused_intent(data)
+        except StructuredOutputError as e:
+            reason = f"输出不合格: {e}"
+        if not reason:
+            with self._route_lock:
+                self._route_stats["fused"] += 1
+            source = data.pop("datasource")
+            data.pop("ambiguous", None)
+            return {"mode": "fused", "intent": {"datasource": source, **data}, "source": source}
+
+        self._log("fallback", reason)
+        with self._route_lock:
+            self._route_stats["fallback"] += 1
+        clarified_req = self._clarify(question)
+        return {"mode": "multi_agent", "intent": self._parse_intent(clarified_req), "clarified_req": clarified_req}
+
+    def _routed_source(self, route: dict, intent: dict) -> str:
+        if route["mode"] == "fused":
+            return route["source"]
+        return self._select_source(intent)
+
+    def _answer_local(self, intent: dict):
+        """本地列存储能覆盖该意图时直接返回结果行，否则（或未开启本地存储）返回 None"""
+        if not LOCAL_STORE:
+            return None
+        rows = self.local_store.answer(intent)
+        if rows is not None:
+            self._log("local", f"本地存储命中 {len(rows)} 条")
+        return rows
+
+    def _lookup_template(self, intent: dict, local=None):
+        """模板命中时返回填好参数的代码，否则（或未开启模板、已由本地存储回答）返回 None"""
+        if not QUERY_TEMPLATES or local is not None:
+            return None
+        code = self.template_cache.lookup(intent)
+        if code is not None:
+            self._log("template_hit", code)
+        return code
+
+    def _retrieve_unless_template(self, intent: dict, template, local=None) -> list:
+        return [] if template is not None or local is not None else self.retrieve_snippets(intent)
+
+    def _write_code(self, intent: dict, snippets: list, template=None, local=None, agent: AssistantAgent = None):
+        if local is not None:
+            return None
+        if template is not None:
+            return template
+        if agent is None and SPECULATIVE_CANDIDATES > 1:
+            # 投机模式下候选代码在执行阶段与执行一起并行生成
+            return None
+        self._log("retrieved_snippets", snippets)
+        code = agent_reply(agent or self.code_writer_agent, self._code_writer_input(intent, snippets))
+        self._log("code", code)
+        return code
+
+    @staticmethod
+    def _code_writer_input(intent: dict, snippets: list) -> str:
+        return (
+            f"意图: {json.dumps(intent, ensure_ascii=False)}\n"
+            f"检索到的示例:\n{json.dumps(snippets, ensure_ascii=False)}\n"
+        )
+
+    def check_code(self, code: str) -> list:
+        """执行前静态校验，返回错误说明列表"""
+        if not VALIDATE_CODE:
+            return []
+        with self._index_lock:
+            index = self.signature_index
+        warnings = []
+        errors = validate_code(code, index, warnings)
+        if warnings:
+            self._log("code_warnings", "\n".join(warnings))
+        return errors
+
+    def execute_code(self, code: str, cancel: threading.Event = None, timeout: float = None) -> dict:
+        errors = self.check_code(code)
+        if errors:
+            return {"ok": False, "exit_code": VALIDATION_EXIT_CODE, "output": "\n".join(errors), "invalid": True}
+        if isinstance(self.executor, WarmCodeExecutor):
+            result = self.executor.pool.run(code + OUTPUT_CHECK, timeout, cancel)
+        else:
+            result = self.executor.execute_code_blocks([CodeBlock(code=code + OUTPUT_CHECK, language="python")])
+        return {"ok": result.exit_code == 0, "exit_code": result.exit_code, "output": result.output}
+
+    def _speculate(self, intent: dict, snippets: list):
+        """
+        N 个候选同时生成，各自生成完立即在独立的执行进程中运行（带超时）；
+        第一个 output 有效的候选胜出，其余尚未开始的直接取消、正在执行的进程被杀掉。
+        全部失败时返回第 0 个候选的结果。
+        """
+        cancel = threading.Event()
+        agents = self.code_writer_candidates
+
+        def attempt(i: int):
+            # 不同候选的示例顺序错开，让首要参考示例不同
+            shift = i % len(snippets) if snippets else 0
+            code = self._write_code(intent, snippets[shift:] + snippets[:shift], agent=agents[i])
+            if cancel.is_set():
+                return i, code, None
+            return i, code, self.execute_code(extract_python(code), cancel, SPECULATIVE_TIMEOUT)
+
+        pool = ThreadPoolExecutor(max_workers=len(agents))
+        # 复制当前上下文，候选中的 token 统计仍计入当前流程阶段
+        pending = {pool.submit(contextvars.copy_context().run, attempt, i) for i in range(len(agents))}
+        attempts = {}
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        i, code, result = future.result()
+                    except Exception as e:
+                        self._log("speculative_error", e)
+                        continue
+                    attempts[i] = (code, result)
+                    if result is not None and result["ok"]:
+                        self._log("speculative_winner", f"候选 {i} 胜出")
+                        return code, {**result, "candidate": i}
+        finally:
+            cancel.set()
+            pool.shutdown(wait=False, cancel_futures=True)
+        if not attempts:
+            raise RuntimeError("全部候选代码生成失败")
+        i = min(attempts)
+        code, result = attempts[i]
+        return code, {**(result or {"ok": False, "exit_code": 1, "output": ""}), "candidate": i}
+
+    def _generate_and_run(self, intent: dict, snippets: list):
+        if SPECULATIVE_CANDIDATES > 1:
+            return self._speculate(intent, snippets)
+        code = self._write_code(intent, snippets)
+        result = self.execute_code(extract_python(code))
+        if result.get("invalid"):
+            # 校验不通过：把精确的错误反馈给 CodeWriter 重写一次，不必先付出启动进程和远程请求的代价
+            self._log("invalid_code", result["output"])
+            code = self._rewrite_code(intent, snippets, code, result["output"])
+            result = self.execute_code(extract_python(code))
+        return code, result
+
+    def _rewrite_code(self, intent: dict, snippets: list, code: str, errors: str) -> str:
+        # 带上原始的意图与检索片段，重写时不丢失上下文
+        history = [
+            {"role": "user", "content": self._code_writer_input(intent, snippets)},
+            {"role": "assistant", "content": code},
+        ]
+        code = agent_reply(
+            self.code_writer_agent,
+            f"上面的代码未通过 mp_api 接口校验：\n{errors}\n请修正后输出完整代码，输出结果仍赋值给 `output` 变量。",
+            history,
+        )
+        self._log("code", code)
+        return code
+
+    def _execute(self, intent: dict, code: str, template, local=None, snippets: list = ()) -> dict:
+        """
+        执行生成的代码（已由本地存储回答时直接返回结果行）。模板代码执行失败时删除该模板，退回检索 + CodeWriter 完整生成一次；
+        非模板代码执行成功时登记为模板
+        """
+        if local is not None:
+            return {"ok": True, "exit_code": 0, "output": local, "code": None, "from_template": False, "from_local": True}
+        if code is None:
+            code, result = self._generate_and_run(intent, list(snippets))
+        else:
+            result = self.execute_code(extract_python(code))
+        if template is not None and not result["ok"]:
+            self._log("template_fallback", result["output"])
+            self.template_cache.invalidate(intent)
+            template = None
+            code, result = self._generate_and_run(intent, self.retrieve_snippets(intent))
+        if QUERY_TEMPLATES and template is None and result["ok"]:
+            self.template_cache.store(intent, extract_python(code))
+        self._log("result", result["output"])
+        return {**result, "code": code, "from_template": template is not None, "from_local": False}
+
+    async def arun(self, user_message: str) -> dict:
+        """
+        在当前事件循环中执行一次查询：需求澄清 -> 意图解析 -> (数据源选择 || 检索) -> 代码生成。
+        返回各阶段输出及 trace（每个阶段的耗时与估算 token 数）
+        """
+        return await self.engine.run(question=user_message)
+
+    def run(self, user_message: str) -> dict:
+        """同步入口，可从多个线程同时调用，受 MP_PIPELINE_CONCURRENCY 限制"""
+        result = self.engine.run_sync(question=user_message)
+        self._log("trace", json.dumps(result["trace"], ensure_ascii=False))
+        return result
+
+    def run_many(self, user_messages: list) -> list:
+        """批量提交多个查询，同时在途；失败的查询在对应位置返回异常对象"""
+        return self.engine.run_many_sync([{"question": m} for m in user_messages])
+
+
+# 进程内共享的默认流程实例
+_default_pipeline = None
+_default_pipeline_lock = threading.Lock()
+
+
+def get_pipeline() -> MPQueryPipeline:
+    global _default_pipeline
+    with _default_pipeline_lock:
+        if _default_pipeline is None:
+            _default_pipeline = MPQueryPipeline()
+        return _default_pipeline
+
+
+def retrieve_snippets(intent: dict, concurrent: bool = None, top_k: int = None, token_budget: int = None) -> list:
+    """检索 Materials Project API 调用示例（使用进程内共享的流程实例，见 MPQueryPipeline.retrieve_snippets）"""
+    return get_pipeline().retrieve_snippets(intent, concurrent, top_k, token_budget)
+
+
+retriever_tool = FunctionTool(
+    func=retrieve_snippets,
+    name="mp_retriever",
+    description="检索 Materials Project API 调用示例"
 )
-# code_executor_agent = ConversableAgent(
-#     name="CodeExecutor",
-#     llm_config=False,
-#     code_execution_config={"executor": executor},
-#     human_input_mode="NEVER"
-# )
-
-# 8. User proxy for initiating chat
-user_agent = UserProxyAgent(name="User", human_input_mode="NEVER", code_execution_config={"use_docker": False})
-
-
-# 9. Assemble GroupChat
-# agents = [
-#     requirement_agent,
-#     intent_agent,
-#     source_agent,
-#     retriever_agent,
-#     code_writer_agent,
-#     # code_executor_agent
-# ]
-# groupchat = GroupChat(agents=agents, messages=[], max_round=200)
-
-# manager = GroupChatManager(
-#     groupchat=groupchat,
-#     system_message="""
-#     让我们开始材料筛选相关工作吧
-#     """,
-#     llm_config=llm_config,
-#     human_input_mode="NEVER"
-# )
+
+
+# 8. Long-lived service mode
+
+def serve_repl(pipeline: MPQueryPipeline):
+    """命令行交互：资源只初始化一次，逐条处理问题，输入空行或 exit 退出"""
+    pipeline.warm_up()
+    while True:
+        try:
+            question = input("\n请输入查询需求> ").strip()
+        except EOFError:
+            break
+        if not question or question.lower() in ("exit", "quit"):
+            break
+        try:
+            pipeline.run(question)
+        except Exception as e:
+            print(f"处理失败: {e}")
+    print(json.dumps(pipeline.stats(), ensure_ascii=False, indent=2))
+
+
+def serve_http(pipeline: MPQueryPipeline, host: str = "127.0.0.1", port: int = 8765):
+    """
+    本地 HTTP 服务：
+    POST /query  {"question": "..."} -> 流程各阶段结果
+    POST /retrieve {"intent": {...}} -> 检索片段
+    GET  /stats  -> 缓存命中统计
+    """
+    pipeline.warm_up()
+
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, status: int, payload):
+            body = json.dumps(payload, ensure_ascii=False).encode("utf8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self._reply(200, pipeline.stats())
+            else:
+                self._reply(404, {"error": "not found"})
+
+        def do_POST(self):
+            routes = {"/query": "question", "/retrieve": "intent"}
+            if self.path not in routes:
+                self._reply(404, {"error": "not found"})
+                return
+            # 只有请求体本身的问题返回 400，流程内部的异常（含 StructuredOutputError）返回 500
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                payload = json.loads(self.rfile.read(length) or b"{}")
+                if not isinstance(payload, dict):
+                    raise ValueError("请求体应为 JSON 对象")
+                argument = payload[routes[self.path]]
+            except (KeyError, ValueError) as e:
+                self._reply(400, {"error": f"请求格式错误: {e}"})
+                return
+            try:
+                if self.path == "/query":
+                    self._reply(200, pipeline.run(argument))
+                else:
+                    self._reply(200, pipeline.retrieve_snippets(argument))
+            except Exception as e:
+                self._reply(500, {"error": str(e)})
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    print(f"MP 查询服务已启动: http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
 
 task = f"""
 请帮我查询 Si 和 O 材料的带隙 band_gap 大于 1eV，并返回 material_id 和 band_gap。
 """
 
-# 新的串行流程，优化检索结果传递
-# 1. 用户输入
-user_message = task
-
-# 2. 需求澄清
-clarified_req = requirement_agent.generate_reply([{"role": "user", "content": user_message}])
-print("-------------------------------- clarified_req --------------------------------")
-print(clarified_req)
-
-# 3. 意图解析
-intent = intent_agent.generate_reply([{"role": "user", "content": clarified_req}])
-print("-------------------------------- intent --------------------------------")
-print(intent)
-
-# 提取 intent 中的 JSON 块
-json_match = re.search(r'```json\s*(.*?)\s*```', intent, re.DOTALL)
-if json_match:
-    intent_json_str = json_match.group(1)
-else:
-    # 尝试直接找大括号包裹的 JSON
-    json_match = re.search(r'({[\s\S]*})', intent)
-    if json_match:
-        intent_json_str = json_match.group(1)
+
+def main():
+    parser = argparse.ArgumentParser(description="Materials Project 多智能体查询")
+    parser.add_argument("questions", nargs="*", default=[task], help="查询需求，可给出多个并发执行，缺省为示例任务")
+    parser.add_argument("--serve", choices=["repl", "http"], help="常驻模式：命令行交互或本地 HTTP 服务")
+    parser.add_argument("--fused", action="store_true", help="融合模式：一次调用完成需求澄清、意图解析与数据源选择")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    global _default_pipeline
+    if args.fused:
+        _default_pipeline = MPQueryPipeline(fused=True)
+
+    if args.serve == "http":
+        serve_http(MPQueryPipeline(interactive=False, fused=args.fused or None), args.host, args.port)
+    elif args.serve == "repl":
+        serve_repl(get_pipeline())
+    elif len(args.questions) == 1:
+        # 1. 用户输入
+        get_pipeline().run(args.questions[0])
     else:
-        raise ValueError("未能在 intent 响应中找到 JSON 块，请检查 agent 输出格式。")
-
-# 4. 数据源选择
-source = source_agent.generate_reply([{"role": "user", "content": intent}])
-print("-------------------------------- source --------------------------------")
-print(source)
-# 5. 检索
-intent_dict = json.loads(intent_json_str)
-retrieved_snippets = retrieve_snippets(intent_dict)
-print("-------------------------------- retrieved_snippets --------------------------------")
-print(retrieved_snippets)
-
-# 6. 组装消息给 code_writer_agent
-code_writer_input = f"意图: {intent}\n检索到的示例:\n{retrieved_snippets}\n"
-code = code_writer_agent.generate_reply([{"role": "user", "content": code_writer_input}])
-
-print(code)
\ No newline at end of file
+        pipeline = get_pipeline()
+        for question, result in zip(args.questions, pipeline.run_many(args.questions)):
+            if isinstance(result, Exception):
+                print(f"处理失败: {question.strip()}: {result}")
+        print(json.dumps(pipeline.stats()["pipeline"], ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
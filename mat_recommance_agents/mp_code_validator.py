@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+生成代码的执行前静态校验。
+
+用 code_clone_and_index.py 抽取的函数记录（函数名、参数、签名）建立签名表，
+对生成代码做 AST 分析：凡是以 MPRester 实例为起点的调用（如 mpr.materials.summary.search(...)），
+检查方法名是否存在于 mp_api 中、关键字参数和位置参数个数是否被某个同名函数接受。
+只在能确定出错时报告，签名未知（旧格式记录）或带 **kwargs 的函数不检查关键字参数；
+调用链中间的属性（如 mpr.session）不对应已索引的 rester 模块时，找不到方法只记为警告，不拦截执行。
+"""
+
+import ast
+import difflib
+from typing import Dict, Iterable, List, Optional, Set
+
+CLIENT_CLASSES = ("MPRester",)
+
+
+class FunctionSpec:
+    def __init__(self, record: Dict):
+        self.name = record["func"]
+        self.file = record.get("file", "").replace("\\", "/").lower()
+        self.path_parts = {part[:-3] if part.endswith(".py") else part for part in self.file.split("/")}
+        self.positional: List[str] = []
+        self.kwonly: List[str] = []
+        self.has_varargs = False
+        # 签名无法解析（旧版索引记录）时视为接受任意关键字参数
+        self.has_varkw = True
+        self.known = False
+        try:
+            args = ast.parse(f"def {record['signature']}: pass").body[0].args
+        except (SyntaxError, AttributeError, KeyError):
+            self.positional = [p for p in record.get("params", []) if p not in ("self", "cls")]
+            return
+        self.positional = [a.arg for a in args.posonlyargs + args.args if a.arg not in ("self", "cls")]
+        self.kwonly = [a.arg for a in args.kwonlyargs]
+        self.has_varargs = args.vararg is not None
+        self.has_varkw = args.kwarg is not None
+        self.known = True
+
+    def accepts_keyword(self, name: str) -> bool:
+        return self.has_varkw or name in self.positional or name in self.kwonly
+
+    def accepts_positional(self, count: int) -> bool:
+        return not self.known or self.has_varargs or count <= len(self.positional)
+
+    def describe(self) -> str:
+        return ", ".join(self.positional + self.kwonly) + (", **kwargs" if self.has_varkw and self.known else "")
+
+
+class SignatureIndex:
+    def __init__(self, records: Iterable[Dict]):
+        self.functions: Dict[str, List[FunctionSpec]] = {}
+        self.path_parts: Set[str] = set()
+        for record in records:
+            spec = FunctionSpec(record)
+            self.functions.setdefault(spec.name, []).append(spec)
+            self.path_parts |= spec.path_parts
+
+    @classmethod
+    def from_docstore(cls, docstore) -> "SignatureIndex":
+        return cls(docstore.get_many(docstore.ids()))
+
+    def candidates(self, name: str, chain: List[str]) -> List[FunctionSpec]:
+        """
+        同名函数中按调用链从近到远匹配文件路径：mpr.materials.summary.search 先找路径中含 summary 的，
+        没有再找含 materials 的，都没有则返回全部同名函数
+        """
+        specs = self.functions.get(name, [])
+        for part in reversed(chain):
+            narrowed = [s for s in specs if part.lower() in s.path_parts]
+            if narrowed:
+                return narrowed
+        return specs
+
+    def resolves(self, chain: List[str]) -> bool:
+        """
+        调用链中间部分是否都对应已索引的模块路径：mpr.materials.summary -> materials/summary.py；
+        没有中间部分时对应 MPRester 本身所在的 mprester.py
+        """
+        parts = [part.lower() for part in chain] or ["mprester"]
+        return all(part in self.path_parts for part in parts)
+
+
+def attribute_chain(node: ast.AST) -> Optional[List[str]]:
+    """mpr.materials.summary.search -> ["mpr", "materials", "summary", "search"]；非纯属性链返回 None"""
+    parts = []
+    while isinstance(node, ast.Attribute):
+        parts.append(node.attr)
+        node = node.value
+    if not isinstance(node, ast.Name):
+        return None
+    parts.append(node.id)
+    return parts[::-1]
+
+
+def client_names(tree: ast.AST) -> Set[str]:
+    """找出绑定到 MPRester 实例的变量名：with MPRester(...) as mpr / mpr = MPRester(...)"""
+    classes = set(CLIENT_CLASSES)
+    for node in ast.walk(tree):
+        if isinstance(node, ast.ImportFrom):
+            for alias in node.names:
+                if alias.name in CLIENT_CLASSES and alias.asname:
+                    classes.add(alias.asname)
+
+    def is_client(call) -> bool:
+        if not isinstance(call, ast.Call):
+            return False
+        chain = attribute_chain(call.func)
+        return bool(chain) and chain[-1] in classes
+
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.With, ast.AsyncWith)):
+            for item in node.items:
+                if is_client(item.context_expr) and isinstance(item.optional_vars, ast.Name):
+                    names.add(item.optional_vars.id)
+        elif isinstance(node, ast.Assign) and is_client(node.value):
+            names.update(t.id for t in node.targets if isinstance(t, ast.Name))
+    return names
+
+
+def validate_code(code: str, index: SignatureIndex, warnings: Optional[List[str]] = None) -> List[str]:
+    """返回错误说明列表，空列表表示通过；传入 warnings 时把无法确定的问题追加到其中"""
+    try:
+        tree = ast.parse(code)
+    except SyntaxError as e:
+        return [f"第 {e.lineno} 行语法错误: {e.msg}"]
+
+    if not index.functions:
+        # 尚未建索引时只做语法检查
+        return []
+    clients = client_names(tree)
+    errors = []
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call):
+            continue
+        chain = attribute_chain(node.func)
+        if not chain or len(chain) < 2 or chain[0] not in clients:
+            continue
+        call_name = ".".join(chain)
+        method = chain[-1]
+        specs = index.candidates(method, chain[1:-1])
+        if not specs:
+            close = difflib.get_close_matches(method, index.functions.keys(), n=3)
+            hint = f"，是否为: {', '.join(close)}" if close else ""
+            message = f"第 {node.lineno} 行 {call_name}(): mp_api 中不存在方法 {method}{hint}"
+            if index.resolves(chain[1:-1]):
+                errors.append(message)
+            elif warnings is not None:
+                # 如 mpr.session.close()：不是 rester 路由上的方法，索引里本来就没有
+                warnings.append(message)
+            continue
+
+        positional = len([a for a in node.args if not isinstance(a, ast.Starred)])
+        if not any(s.accepts_positional(positional) for s in specs):
+            errors.append(f"第 {node.lineno} 行 {call_name}(): 位置参数过多（{positional} 个），签名为 ({specs[0].describe()})")
+        for keyword in node.keywords:
+            if keyword.arg is None:  # **kwargs 展开无法静态检查
+                continue
+            if not any(s.accepts_keyword(keyword.arg) for s in specs):
+                accepted = sorted({p for s in specs for p in s.positional + s.kwonly})
+                close = difflib.get_close_matches(keyword.arg, accepted, n=3)
+                hint = f"，是否为: {', '.join(close)}" if close else ""
+                errors.append(
+                    f"第 {node.lineno} 行 {call_name}(): 不接受参数 {keyword.arg}{hint}；可用参数: {', '.join(accepted)}"
+                )
+    return errors
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+单文件打包的函数文档库，替代成千上万个 fn_{id}.json。
+
+- 数据文件 (*.pack)：逐条追加的函数记录，每条独立 zlib 压缩（可关闭），支持随机访问
+- 索引文件 (*.idx)：{id: [offset, length]}，加载后按 id O(1) 定位
+- 读取端使用 mmap，批量读取按 offset 排序，顺序访问磁盘
+"""
+
+import json
+import mmap
+import os
+import zlib
+from typing import Dict, Iterable, List, Optional
+
+DEFAULT_DOCSTORE_PATH = "./mp_docstore.pack"
+# 失效数据超过该比例时整体重写，回收空间
+COMPACT_RATIO = 0.5
+
+
+class DocStore:
+    def __init__(self, path: str = DEFAULT_DOCSTORE_PATH, compress: bool = True):
+        self.path = path
+        self.index_path = os.path.splitext(path)[0] + ".idx"
+        self.compress = compress
+        self.entries: Dict[str, List[int]] = {}
+        self._file = None
+        self._mmap = None
+        self._load_index()
+
+    # ---------- 读取 ----------
+    def _load_index(self):
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r", encoding="utf8") as f:
+                meta = json.load(f)
+            self.compress = meta["compress"]
+            self.entries = meta["entries"]
+
+    def _buffer(self):
+        if self._mmap is None:
+            self._file = open(self.path, "rb")
+            # 空文件无法 mmap
+            if os.fstat(self._file.fileno()).st_size == 0:
+                return b""
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def open(self):
+        """预先打开数据文件（默认在第一次读取时打开），之后的读取都对应当前这一版 offset"""
+        self._buffer()
+        return self
+
+    def _decode(self, raw: bytes) -> Dict:
+        if self.compress:
+            raw = zlib.decompress(raw)
+        return json.loads(raw.decode("utf8"))
+
+    def __contains__(self, idx) -> bool:
+        return str(idx) in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def ids(self) -> List[str]:
+        return list(self.entries)
+
+    def get(self, idx) -> Optional[Dict]:
+        entry = self.entries.get(str(idx))
+        if entry is None:
+            return None
+        offset, length = entry
+        return self._decode(self._buffer()[offset:offset + length])
+
+    def get_many(self, ids: Iterable) -> List[Dict]:
+        """按输入顺序返回记录，内部按 offset 顺序读取；不存在的 id 被跳过"""
+        wanted = [str(i) for i in ids if str(i) in self.entries]
+        buf = self._buffer() if wanted else b""
+        loaded = {}
+        for idx in sorted(set(wanted), key=lambda i: self.entries[i][0]):
+            offset, length = self.entries[idx]
+            loaded[idx] = self._decode(buf[offset:offset + length])
+        return [loaded[i] for i in wanted]
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    # ---------- 写入 ----------
+    def _encode(self, record: Dict) -> bytes:
+        raw = json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf8")
+        return zlib.compress(raw) if self.compress else raw
+
+    def _save_index(self):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf8") as f:
+            json.dump({"compress": self.compress, "entries": self.entries}, f)
+        os.replace(tmp_path, self.index_path)
+
+    def write(self, upserts: List[Dict], removed_ids: Iterable = ()):
+        """追加写入新/变更记录（按 record['id']），删除失效记录；调用 flush() 后索引才落盘"""
+        self.close()
+        for idx in removed_ids:
+            self.entries.pop(str(idx), None)
+        if not upserts:
+            return
+        with open(self.path, "ab") as f:
+            offset = f.tell()
+            for r in upserts:
+                data = self._encode(r)
+                f.write(data)
+                self.entries[str(r["id"])] = [offset, len(data)]
+                offset += len(data)
+
+    def flush(self):
+        """保存索引，失效数据过多时压缩重写"""
+        total = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        live = sum(length for _, length in self.entries.values())
+        if total and (total - live) / total > COMPACT_RATIO:
+            self.compact()
+        else:
+            self._save_index()
+
+    def update(self, upserts: List[Dict], removed_ids: Iterable = ()):
+        self.write(upserts, removed_ids)
+        self.flush()
+
+    def compact(self):
+        """按 id 顺序重写数据文件，丢弃已被覆盖或删除的记录"""
+        self.close()
+        tmp_path = self.path + ".tmp"
+        entries = {}
+        with open(self.path, "rb") as src, open(tmp_path, "wb") as dst:
+            for idx, (offset, length) in sorted(self.entries.items()):
+                src.seek(offset)
+                entries[idx] = [dst.tell(), length]
+                dst.write(src.read(length))
+        os.replace(tmp_path, self.path)
+        self.entries = entries
+        self._save_index()
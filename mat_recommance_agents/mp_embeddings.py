@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+MP 函数索引的嵌入层：文本去重 + 最大批量请求 + 限速并发 + 磁盘缓存。
+
+缓存以 (模型名, 文本 sha256) 为键存放在 sqlite 中，
+同一段文本在多次运行之间、doc/param/return 三个索引之间都只嵌入一次。
+
+嵌入后端通过环境变量 MP_EMBEDDING_BACKEND 选择：
+- "openai"（默认）：远程 text-embedding-3-small
+- "local"：CPU 上的特征哈希嵌入，完全离线、无需下载模型
+- "hf"：本地 sentence-transformers 模型（MP_LOCAL_EMBEDDING_MODEL 指定路径或名称）
+"""
+
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+DEFAULT_CACHE_PATH = "./mp_embedding_cache.sqlite"
+EMBEDDING_BACKEND = os.getenv("MP_EMBEDDING_BACKEND", "openai")
+OPENAI_EMBEDDING_MODEL = "text-embedding-3-small"
+LOCAL_EMBEDDING_MODEL = os.getenv("MP_LOCAL_EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+HASHING_DIM = 1024
+
+
+class RateLimiter:
+    """
+    简单的滑动窗口限速器，同时约束每分钟请求数 (rpm) 与每分钟 token 数 (tpm)。
+    token 数按 4 字符 ≈ 1 token 粗略估算。
+    """
+
+    def __init__(self, rpm: Optional[int] = None, tpm: Optional[int] = None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._events = []  # [(时间戳, token 数)]
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: int = 0):
+        if not self.rpm and not self.tpm:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._events = [(t, n) for t, n in self._events if now - t < 60]
+                used_requests = len(self._events)
+                used_tokens = sum(n for _, n in self._events)
+                request_ok = not self.rpm or used_requests < self.rpm
+                # 单个请求超过 tpm 时只要窗口为空就放行，避免永久阻塞
+                token_ok = not self.tpm or used_tokens + tokens <= self.tpm or not self._events
+                if request_ok and token_ok:
+                    self._events.append((now, tokens))
+                    return
+                wait = 60 - (now - self._events[0][0])
+            time.sleep(max(wait, 0.05))
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+
+class EmbeddingCache:
+    """(模型名, 文本 hash) -> float32 向量 的 sqlite 持久缓存"""
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, model TEXT, vector BLOB)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def key(model: str, text: str) -> str:
+        return hashlib.sha256(f"{model}\0{text}".encode("utf8")).hexdigest()
+
+    def get_many(self, model: str, texts: List[str]) -> Dict[str, List[float]]:
+        keys = {self.key(model, t): t for t in texts}
+        found = {}
+        key_list = list(keys)
+        with self._lock:
+            # sqlite 单条语句的参数个数有限，分段查询
+            for i in range(0, len(key_list), 500):
+                chunk = key_list[i:i + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                for k, blob in rows:
+                    found[keys[k]] = array("f", blob).tolist()
+        return found
+
+    def put_many(self, model: str, vectors: Dict[str, List[float]]):
+        rows = [(self.key(model, t), model, array("f", v).tobytes()) for t, v in vectors.items()]
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)", rows)
+            self._conn.commit()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    包装任意 LangChain Embeddings：
+    - 对输入文本去重，空白文本不缓存（调用方应先过滤掉，见 FieldVectorIndex.upsert）
+    - 只嵌入缓存未命中的文本，按 batch_size / 每批 token 上限切成最大批量
+    - 批次在 max_concurrency 个线程中并发执行，受 RateLimiter 约束
+    - 结果写回磁盘缓存
+    - memory_size > 0 时在磁盘缓存之前加一层进程内 LRU（检索端查询向量用）
+    """
+
+    def __init__(self, base: Embeddings, model: str, cache_path: str = DEFAULT_CACHE_PATH,
+                 batch_size: int = 1024, max_batch_tokens: int = 250_000,
+                 max_concurrency: int = 4, rpm: Optional[int] = None, tpm: Optional[int] = None,
+                 memory_size: int = 0):
+        self.base = base
+        self.model = model
+        self.cache = EmbeddingCache(cache_path)
+        self.batch_size = batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.max_concurrency = max_concurrency
+        self.limiter = RateLimiter(rpm, tpm)
+        self.memory_size = memory_size
+        self._memory: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._memory_lock = threading.Lock()
+        self.stats = {"requested": 0, "unique": 0, "memory_hits": 0, "cache_hits": 0, "embedded": 0, "batches": 0}
+
+    def _memory_get(self, texts: List[str]) -> Dict[str, List[float]]:
+        found = {}
+        if not self.memory_size:
+            return found
+        with self._memory_lock:
+            for t in texts:
+                if t in self._memory:
+                    self._memory.move_to_end(t)
+                    found[t] = self._memory[t]
+        return found
+
+    def _memory_put(self, vectors: Dict[str, List[float]]):
+        if not self.memory_size:
+            return
+        with self._memory_lock:
+            for t, v in vectors.items():
+                self._memory[t] = v
+                self._memory.move_to_end(t)
+            while len(self._memory) > self.memory_size:
+                self._memory.popitem(last=False)
+
+    def _make_batches(self, texts: List[str]) -> List[List[str]]:
+        batches, current, current_tokens = [], [], 0
+        for t in texts:
+            n = estimate_tokens(t)
+            if current and (len(current) >= self.batch_size or current_tokens + n > self.max_batch_tokens):
+                batches.append(current)
+                current, current_tokens = [], 0
+            current.append(t)
+            current_tokens += n
+        if current:
+            batches.append(current)
+        return batches
+
+    def _embed_batch(self, batch: List[str]) -> Dict[str, List[float]]:
+        self.limiter.acquire(sum(estimate_tokens(t) for t in batch))
+        return dict(zip(batch, self.base.embed_documents(batch)))
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        unique = list(dict.fromkeys(texts))
+        self.stats["requested"] += len(texts)
+        self.stats["unique"] += len(unique)
+
+        non_empty = [t for t in unique if t.strip()]
+        vectors = self._memory_get(non_empty)
+        self.stats["memory_hits"] += len(vectors)
+        on_disk = self.cache.get_many(self.model, [t for t in non_empty if t not in vectors])
+        self.stats["cache_hits"] += len(on_disk)
+        vectors.update(on_disk)
+        missing = [t for t in non_empty if t not in vectors]
+
+        if missing:
+            batches = self._make_batches(missing)
+            self.stats["batches"] += len(batches)
+            with ThreadPoolExecutor(max_workers=max(1, self.max_concurrency)) as pool:
+                for result in pool.map(self._embed_batch, batches):
+                    self.cache.put_many(self.model, result)
+                    vectors.update(result)
+            self.stats["embedded"] += len(missing)
+        self._memory_put({t: vectors[t] for t in non_empty})
+
+        empties = [t for t in unique if not t.strip()]
+        if empties:
+            # 空白文本不进缓存，原样交给底层模型；建索引与检索时都会先跳过空白文本
+            vectors.update(zip(empties, self.base.embed_documents(empties)))
+
+        return [vectors[t] for t in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+_TOKEN_RE = re.compile(r"[A-Za-z]+|\d+|[\u4e00-\u9fff]")
+_WORD_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+
+
+@lru_cache(maxsize=200_000)
+def _hash_token(token: str, dim: int) -> Tuple[int, float]:
+    """稳定哈希（不受 PYTHONHASHSEED 影响），返回 (桶下标, 符号)"""
+    h = int.from_bytes(hashlib.blake2b(token.encode("utf8"), digest_size=8).digest(), "little")
+    return h % dim, (1.0 if h >> 63 else -1.0)
+
+
+class HashingEmbeddings(Embeddings):
+    """
+    离线特征哈希嵌入，与 OpenAIEmbeddings 接口一致。
+    特征：完整标识符（band_gap）、拆分后的词（band、gap）、字符 3-gram（权重减半），
+    通过带符号哈希映射到固定维度后 L2 归一化。适合 API 名称、参数名这类词面相似度检索。
+    不含任何词的文本得到零向量，FieldVectorIndex 不会索引也不会用它检索。
+    """
+
+    def __init__(self, dim: int = HASHING_DIM, ngram: int = 3):
+        self.dim = dim
+        self.ngram = ngram
+
+    @property
+    def model_name(self) -> str:
+        return f"local-hashing-{self.dim}-{self.ngram}"
+
+    def _features(self, text: str) -> Dict[int, float]:
+        weights = {}
+
+        def add(token: str, weight: float):
+            col, sign = _hash_token(token, self.dim)
+            weights[col] = weights.get(col, 0.0) + sign * weight
+
+        lowered = text.lower()
+        for ident in _WORD_RE.findall(lowered):
+            if "_" in ident:
+                add(ident, 1.0)
+        for token in _TOKEN_RE.findall(lowered):
+            add(token, 1.0)
+            if len(token) > self.ngram:
+                padded = f"#{token}#"
+                for i in range(len(padded) - self.ngram + 1):
+                    add(padded[i:i + self.ngram], 0.5)
+        return weights
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            features = self._features(text)
+            if features:
+                matrix[row, list(features)] = list(features.values())
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return (matrix / norms).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+def embedding_model_name(backend: str = EMBEDDING_BACKEND) -> str:
+    """用于缓存键与 manifest 的模型标识，切换后端会触发全量重建"""
+    if backend == "local":
+        return HashingEmbeddings().model_name
+    if backend == "hf":
+        return f"hf:{LOCAL_EMBEDDING_MODEL}"
+    return OPENAI_EMBEDDING_MODEL
+
+
+def make_base_embeddings(backend: str = EMBEDDING_BACKEND) -> Embeddings:
+    """按配置创建嵌入后端；本地后端无需 API_KEY 与网络"""
+    if backend == "local":
+        return HashingEmbeddings()
+    if backend == "hf":
+        from langchain_community.embeddings import HuggingFaceEmbeddings
+        return HuggingFaceEmbeddings(model_name=LOCAL_EMBEDDING_MODEL, model_kwargs={"device": "cpu"})
+    if backend != "openai":
+        raise ValueError(f"未知的嵌入后端: {backend}")
+    from langchain_community.embeddings import OpenAIEmbeddings
+    return OpenAIEmbeddings(api_key=os.getenv("API_KEY"), base_url=os.getenv("BASE_URL"), model=OPENAI_EMBEDDING_MODEL)
+
+
+def is_remote_backend(backend: str = EMBEDDING_BACKEND) -> bool:
+    return backend == "openai"
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+MP 函数的词面倒排索引（BM25），覆盖函数名、参数名与签名。
+
+意图里的过滤键（band_gap、elements、material_ids ...）往往与函数参数名逐字相同，
+这类查询直接查倒排表即可得到结果，无需任何嵌入请求；
+其余查询的 BM25 排名可与向量检索结果一起做排名融合。
+"""
+
+import json
+import math
+import os
+import re
+from typing import Dict, Iterable, List, Tuple
+
+DEFAULT_LEXICAL_PATH = "./mp_lexical.json"
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_IDENT_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+
+
+def tokenize(text: str) -> List[str]:
+    """完整标识符 + 按下划线拆分的子词，统一小写"""
+    tokens = []
+    for ident in _IDENT_RE.findall(text.lower()):
+        tokens.append(ident)
+        parts = [p for p in ident.split("_") if p]
+        if len(parts) > 1:
+            tokens.extend(parts)
+    return tokens
+
+
+class LexicalIndex:
+    def __init__(self, path: str = DEFAULT_LEXICAL_PATH):
+        self.path = path
+        self.docs: Dict[str, Dict[str, List[str]]] = {}  # id -> {"tokens": [...], "params": [...]}
+        self.postings: Dict[str, Dict[str, int]] = {}   # token -> {id: 词频}
+        self.param_postings: Dict[str, set] = {}         # 参数名 -> {id}
+        self.lengths: Dict[str, int] = {}
+        self.total_length = 0
+
+    @classmethod
+    def load(cls, path: str = DEFAULT_LEXICAL_PATH) -> "LexicalIndex":
+        index = cls(path)
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf8") as f:
+                docs = json.load(f)["docs"]
+            for fn_id, doc in docs.items():
+                index._add(fn_id, doc)
+        return index
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf8") as f:
+            json.dump({"docs": self.docs}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    # ---------- 维护 ----------
+    def _add(self, fn_id: str, doc: Dict[str, List[str]]):
+        self.docs[fn_id] = doc
+        for token in doc["tokens"]:
+            bucket = self.postings.setdefault(token, {})
+            bucket[fn_id] = bucket.get(fn_id, 0) + 1
+        for name in doc["params"]:
+            self.param_postings.setdefault(name, set()).add(fn_id)
+        self.lengths[fn_id] = len(doc["tokens"])
+        self.total_length += len(doc["tokens"])
+
+    def _remove(self, fn_id: str):
+        doc = self.docs.pop(fn_id, None)
+        if doc is None:
+            return
+        for token in set(doc["tokens"]):
+            bucket = self.postings.get(token, {})
+            bucket.pop(fn_id, None)
+            if not bucket:
+                self.postings.pop(token, None)
+        for name in doc["params"]:
+            ids = self.param_postings.get(name, set())
+            ids.discard(fn_id)
+            if not ids:
+                self.param_postings.pop(name, None)
+        self.total_length -= self.lengths.pop(fn_id, 0)
+
+    def update(self, upserts: List[Dict], removed_ids: Iterable[str] = ()):
+        """与 docstore / 向量索引同步：按函数 id 删除、覆盖"""
+        for fn_id in removed_ids:
+            self._remove(fn_id)
+        for r in upserts:
+            self._remove(r["id"])
+            params = [p.lower() for p in r["params"] if p != "self"]
+            self._add(r["id"], {"tokens": tokenize(r["signature"]) + params, "params": params})
+
+    # ---------- 查询 ----------
+    def has_param(self, name: str) -> bool:
+        return name.strip().lower() in self.param_postings
+
+    def search(self, text: str, k: int, candidates: Iterable[str] = None) -> List[Tuple[str, float]]:
+        """BM25 打分，返回按分数降序的 [(函数 id, 分数)]；candidates 限定候选集合"""
+        if not self.docs:
+            return []
+        n_docs = len(self.docs)
+        avg_length = self.total_length / n_docs
+        allowed = set(candidates) if candidates is not None else None
+        scores: Dict[str, float] = {}
+        for token in set(tokenize(text)):
+            bucket = self.postings.get(token)
+            if not bucket:
+                continue
+            idf = math.log(1 + (n_docs - len(bucket) + 0.5) / (len(bucket) + 0.5))
+            for fn_id, tf in bucket.items():
+                if allowed is not None and fn_id not in allowed:
+                    continue
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[fn_id] / avg_length)
+                scores[fn_id] = scores.get(fn_id, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+        return sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:k]
+
+    def search_param(self, name: str, k: int) -> List[Tuple[str, float]]:
+        """参数名逐字命中：候选限定为拥有该参数的函数，再按 BM25 排序（签名越精简越靠前）"""
+        ids = self.param_postings.get(name.strip().lower(), set())
+        return self.search(name, k, candidates=ids)
@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地材料属性列存储，作为 SourceSelector 中的 "local" 数据源。
+
+把已从 Materials Project 拉取的 summary 文档物化为列：
+- 数值列：float64 数组（缺失为 NaN），加载时为每列建立排序索引，区间条件用二分查找
+- 元素集合：每个材料一个 128 位位掩码（两个 uint64），"包含全部元素" / "化学体系完全相同" 用位运算判断
+- 字符串列：object 数组，等值比较
+
+新鲜度策略：每次同步记录一个覆盖范围（同步时的元素条件）及同步时间。
+意图只有在被某个未过期（max_age 以内）的覆盖范围完整覆盖、且所有过滤键和返回字段都是已知列时才在本地回答，
+否则退回远程 API。
+
+用法：
+    python mp_local_store.py sync --elements Si,O
+    python mp_local_store.py info
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+DEFAULT_STORE_DIR = "./mp_local_store"
+DEFAULT_MAX_AGE = 7 * 24 * 3600
+# 同步时拉取的 summary 字段
+SYNC_FIELDS = [
+    "material_id", "formula_pretty", "chemsys", "elements", "nelements", "nsites",
+    "band_gap", "energy_above_hull", "formation_energy_per_atom", "density", "volume",
+    "is_stable", "is_metal", "is_magnetic", "total_magnetization",
+]
+
+ELEMENTS = (
+    "H He Li Be B C N O F Ne Na Mg Al Si P S Cl Ar K Ca Sc Ti V Cr Mn Fe Co Ni Cu Zn Ga Ge As Se Br Kr "
+    "Rb Sr Y Zr Nb Mo Tc Ru Rh Pd Ag Cd In Sn Sb Te I Xe Cs Ba La Ce Pr Nd Pm Sm Eu Gd Tb Dy Ho Er Tm Yb "
+    "Lu Hf Ta W Re Os Ir Pt Au Hg Tl Pb Bi Po At Rn Fr Ra Ac Th Pa U Np Pu Am Cm Bk Cf Es Fm Md No Lr "
+    "Rf Db Sg Bh Hs Mt Ds Rg Cn Nh Fl Mc Lv Ts Og"
+).split()
+ELEMENT_BIT = {symbol: i for i, symbol in enumerate(ELEMENTS)}
+
+# 区间条件的写法：{"min": 1.0} / {"gte": 1.0} / {"gt": 1.0} / [1.0, null] ...
+_LOWER = {"min": False, "gte": False, "ge": False, "gt": True}
+_UPPER = {"max": False, "lte": False, "le": False, "lt": True}
+_ELEMENT_FILTERS = ("elements", "exclude_elements", "chemsys")
+
+
+def element_mask(symbols: Iterable[str]) -> np.ndarray:
+    """元素集合 -> 两个 uint64 组成的位掩码；未知元素抛出 KeyError"""
+    mask = np.zeros(2, dtype=np.uint64)
+    for symbol in symbols:
+        bit = ELEMENT_BIT[str(symbol).strip()]
+        mask[bit // 64] |= np.uint64(1) << np.uint64(bit % 64)
+    return mask
+
+
+def _element_list(value) -> List[str]:
+    if isinstance(value, str):
+        return [s for s in value.replace(",", "-").split("-") if s.strip()]
+    return [str(s) for s in value]
+
+
+def _plain(value):
+    """mp_api 文档中的 MPID / Element / 枚举等转成普通 Python 值"""
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, (list, tuple, set)):
+        return [_plain(v) for v in value]
+    if hasattr(value, "value") and isinstance(value.value, (str, int, float)):
+        return value.value
+    return str(value)
+
+
+class LocalPropertyStore:
+    def __init__(self, store_dir: str = DEFAULT_STORE_DIR, max_age: float = DEFAULT_MAX_AGE):
+        self.store_dir = store_dir
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self.material_ids: List[str] = []
+        self.numeric: Dict[str, np.ndarray] = {}
+        self.strings: Dict[str, np.ndarray] = {}
+        self.masks = np.zeros((0, 2), dtype=np.uint64)
+        self.fetched_at = np.zeros(0)
+        self.booleans = set()  # 以 0/1 存放的布尔列
+        self.scopes: List[dict] = []  # [{"elements": [...], "fetched_at": 时间戳}]
+        self._sorted: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        self.stats = {"answered": 0, "fallbacks": 0}
+        self._load()
+
+    # ---------- 持久化 ----------
+    def _load(self):
+        meta_path = os.path.join(self.store_dir, "meta.json")
+        if not os.path.exists(meta_path):
+            return
+        with open(meta_path, "r", encoding="utf8") as f:
+            meta = json.load(f)
+        arrays = np.load(os.path.join(self.store_dir, "columns.npz"))
+        self.material_ids = meta["material_ids"]
+        self.scopes = meta["scopes"]
+        self.booleans = set(meta.get("booleans", []))
+        self.strings = {name: np.asarray(values, dtype=object) for name, values in meta["strings"].items()}
+        self.numeric = {name: arrays[f"num_{name}"] for name in meta["numeric"]}
+        self.masks = arrays["masks"]
+        self.fetched_at = arrays["fetched_at"]
+        self._build_sorted()
+
+    def save(self):
+        os.makedirs(self.store_dir, exist_ok=True)
+        arrays = {f"num_{name}": col for name, col in self.numeric.items()}
+        tmp_npz = os.path.join(self.store_dir, "columns.tmp.npz")
+        np.savez(tmp_npz, masks=self.masks, fetched_at=self.fetched_at, **arrays)
+        meta = {
+            "material_ids": self.material_ids,
+            "scopes": self.scopes,
+            "numeric": list(self.numeric),
+            "booleans": sorted(self.booleans),
+            "strings": {name: col.tolist() for name, col in self.strings.items()},
+        }
+        tmp_meta = os.path.join(self.store_dir, "meta.tmp.json")
+        with open(tmp_meta, "w", encoding="utf8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(tmp_npz, os.path.join(self.store_dir, "columns.npz"))
+        os.replace(tmp_meta, os.path.join(self.store_dir, "meta.json"))
+
+    def _build_sorted(self):
+        # 数值列的排序索引：NaN 排在末尾，区间查询时排除
+        self._sorted = {}
+        for name, col in self.numeric.items():
+            order = np.argsort(col, kind="stable")
+            self._sorted[name] = (order, col[order])
+
+    # ---------- 物化 ----------
+    def materialize(self, docs: Iterable, scope_elements: Optional[Iterable[str]] = None):
+        """
+        写入一批 summary 文档（dict 或 mp_api 文档对象），按 material_id 覆盖旧记录。
+        scope_elements 不为 None 时表示这批文档是"包含这些元素的全部材料"，登记为一个覆盖范围。
+        """
+        now = time.time()
+        rows: Dict[str, dict] = {}
+        for doc in docs:
+            if not isinstance(doc, dict):
+                doc = doc.model_dump() if hasattr(doc, "model_dump") else dict(doc.__dict__)
+            record = {k: _plain(v) for k, v in doc.items() if not k.startswith("_")}
+            rows[str(record["material_id"])] = record
+
+        with self._lock:
+            keep = np.array([mid not in rows for mid in self.material_ids], dtype=bool)
+            new_ids = [mid for mid, k in zip(self.material_ids, keep) if k] + list(rows)
+            new_records = list(rows.values())
+
+            # 列集合：已有列 + 新文档中出现的标量字段
+            numeric_names = set(self.numeric)
+            string_names = set(self.strings)
+            for record in new_records:
+                for key, value in record.items():
+                    if key in ("material_id", "elements") or isinstance(value, (list, dict)) or value is None:
+                        continue
+                    if isinstance(value, (bool, int, float)):
+                        if key not in string_names:
+                            numeric_names.add(key)
+                            if isinstance(value, bool):
+                                self.booleans.add(key)
+                    else:
+                        string_names.add(key)
+                        numeric_names.discard(key)
+
+            n_old = int(keep.sum())
+            numeric = {}
+            for name in numeric_names:
+                old = self.numeric[name][keep] if name in self.numeric else np.full(n_old, np.nan)
+                new = np.array([_to_float(r.get(name)) for r in new_records], dtype=np.float64)
+                numeric[name] = np.concatenate([old, new])
+            strings = {}
+            for name in string_names:
+                old = self.strings[name][keep] if name in self.strings else np.full(n_old, None, dtype=object)
+                new = np.array([None if r.get(name) is None else str(r.get(name)) for r in new_records], dtype=object)
+                strings[name] = np.concatenate([old, new])
+            masks = np.concatenate([
+                self.masks[keep],
+                np.array([element_mask(r.get("elements") or []) for r in new_records], dtype=np.uint64).reshape(-1, 2),
+            ])
+
+            self.material_ids = new_ids
+            self.numeric, self.strings, self.masks = numeric, strings, masks
+            self.fetched_at = np.concatenate([self.fetched_at[keep], np.full(len(new_records), now)])
+            if scope_elements is not None:
+                scope = sorted(_element_list(scope_elements))
+                self.scopes = [s for s in self.scopes if s["elements"] != scope] + [{"elements": scope, "fetched_at": now}]
+            self._build_sorted()
+
+    def sync(self, api_key: str, elements: Iterable[str]):
+        """从 MP 拉取包含给定元素的全部材料的 summary 字段并物化为一个覆盖范围"""
+        from mp_api.client import MPRester
+
+        elements = _element_list(elements)
+        with MPRester(api_key) as mpr:
+            docs = mpr.materials.summary.search(elements=elements or None, fields=SYNC_FIELDS)
+        self.materialize(docs, scope_elements=elements)
+        self.save()
+        return len(docs)
+
+    # ---------- 查询 ----------
+    def coverage(self, intent: dict) -> Tuple[bool, str]:
+        """判断意图能否在本地回答，返回 (能否回答, 原因)"""
+        filters = intent.get("filters") or {}
+        fields = intent.get("fields") or []
+        columns = set(self.numeric) | set(self.strings) | {"material_id", "elements"}
+        unknown = [k for k in list(filters) + list(fields) if k not in columns and k not in _ELEMENT_FILTERS]
+        if unknown:
+            return False, f"本地没有这些列: {unknown}"
+        try:
+            wanted = set(_element_list(filters.get("elements") or []))
+            if filters.get("chemsys"):
+                wanted |= set(_element_list(filters["chemsys"]))
+        except TypeError:
+            return False, "元素条件格式无法识别"
+        now = time.time()
+        expired = None
+        for scope in self.scopes:
+            # 覆盖范围是"包含 scope 元素的全部材料"，意图要求的元素是其超集时结果完整；
+            # 任一未过期的覆盖范围都可以回答，全部过期才退回远程查询
+            if set(scope["elements"]) <= wanted:
+                if now - scope["fetched_at"] <= self.max_age:
+                    return True, f"覆盖范围 {scope['elements']}"
+                expired = expired or scope
+        if expired is not None:
+            return False, f"覆盖范围 {expired['elements']} 已过期"
+        return False, "没有覆盖该元素条件的同步记录"
+
+    def _range_rows(self, name: str, lower=None, upper=None, lower_open=False, upper_open=False) -> np.ndarray:
+        order, values = self._sorted[name]
+        n_valid = len(values) - int(np.isnan(values).sum())
+        lo = 0 if lower is None else np.searchsorted(values[:n_valid], lower, side="right" if lower_open else "left")
+        hi = n_valid if upper is None else np.searchsorted(values[:n_valid], upper, side="left" if upper_open else "right")
+        return order[lo:hi]
+
+    def _numeric_mask(self, name: str, condition) -> np.ndarray:
+        mask = np.zeros(len(self.material_ids), dtype=bool)
+        if isinstance(condition, dict):
+            lower = upper = None
+            lower_open = upper_open = False
+            for key, value in condition.items():
+                if value is None:
+                    continue
+                if key in _LOWER:
+                    lower, lower_open = float(value), _LOWER[key]
+                elif key in _UPPER:
+                    upper, upper_open = float(value), _UPPER[key]
+                elif key in ("eq", "equals"):
+                    lower = upper = float(value)
+                else:
+                    raise ValueError(f"无法识别的区间条件: {name}.{key}")
+            mask[self._range_rows(name, lower, upper, lower_open, upper_open)] = True
+        elif isinstance(condition, (list, tuple)) and len(condition) == 2:
+            lower, upper = (None if v is None else float(v) for v in condition)
+            mask[self._range_rows(name, lower, upper)] = True
+        else:
+            mask = self.numeric[name] == float(condition)
+        return mask
+
+    def query(self, intent: dict) -> List[dict]:
+        """对本地列做向量化过滤，返回 [{字段: 值}]；字段缺省时返回全部列"""
+        filters = intent.get("filters") or {}
+        with self._lock:
+            selected = np.ones(len(self.material_ids), dtype=bool)
+            for name, condition in filters.items():
+                if name == "elements":
+                    required = element_mask(_element_list(condition))
+                    selected &= ((self.masks & required) == required).all(axis=1)
+                elif name == "exclude_elements":
+                    excluded = element_mask(_element_list(condition))
+                    selected &= ((self.masks & excluded) == 0).all(axis=1)
+                elif name == "chemsys":
+                    selected &= (self.masks == element_mask(_element_list(condition))).all(axis=1)
+                elif name in self.numeric:
+                    selected &= self._numeric_mask(name, condition)
+                elif name in self.strings:
+                    values = condition if isinstance(condition, (list, tuple)) else [condition]
+                    selected &= np.isin(self.strings[name], [str(v) for v in values])
+                elif name == "material_id":
+                    values = condition if isinstance(condition, (list, tuple)) else [condition]
+                    selected &= np.isin(np.asarray(self.material_ids, dtype=object), [str(v) for v in values])
+
+            rows = np.flatnonzero(selected)
+            fields = list(intent.get("fields") or ["material_id", *self.strings, *self.numeric])
+            columns = {}
+            for name in fields:
+                if name == "material_id":
+                    columns[name] = [self.material_ids[i] for i in rows]
+                elif name == "elements":
+                    columns[name] = [_mask_elements(self.masks[i]) for i in rows]
+                elif name in self.numeric:
+                    values = [_from_float(v) for v in self.numeric[name][rows]]
+                    columns[name] = [None if v is None else bool(v) for v in values] if name in self.booleans else values
+                else:
+                    columns[name] = self.strings[name][rows].tolist()
+        return [dict(zip(fields, values)) for values in zip(*(columns[f] for f in fields))]
+
+    def answer(self, intent: dict) -> Optional[List[dict]]:
+        """能在本地回答时返回结果，否则返回 None（调用方走远程 API）"""
+        ok, _ = self.coverage(intent)
+        try:
+            result = self.query(intent) if ok else None
+        except (KeyError, ValueError, TypeError):
+            result = None
+        with self._lock:
+            self.stats["answered" if result is not None else "fallbacks"] += 1
+        return result
+
+    def info(self) -> dict:
+        with self._lock:
+            return {
+                **self.stats,
+                "materials": len(self.material_ids),
+                "numeric_columns": sorted(self.numeric),
+                "string_columns": sorted(self.strings),
+                "scopes": [
+                    {**s, "age_hours": round((time.time() - s["fetched_at"]) / 3600, 2)} for s in self.scopes
+                ],
+                "max_age": self.max_age,
+            }
+
+
+def _to_float(value) -> float:
+    if value is None:
+        return np.nan
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _from_float(value: float):
+    return None if np.isnan(value) else float(value)
+
+
+def _mask_elements(mask: np.ndarray) -> List[str]:
+    return [symbol for symbol, bit in ELEMENT_BIT.items()
+            if int(mask[bit // 64]) >> (bit % 64) & 1]
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="本地材料属性列存储")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_sync = sub.add_parser("sync", help="从 MP 拉取包含给定元素的全部材料")
+    p_sync.add_argument("--elements", default="", help="逗号分隔的元素，如 Si,O；留空表示全部材料")
+    sub.add_parser("info", help="查看列、覆盖范围与新鲜度")
+    args = parser.parse_args()
+
+    store = LocalPropertyStore(max_age=float(os.getenv("MP_LOCAL_MAX_AGE", DEFAULT_MAX_AGE)))
+    if args.command == "sync":
+        n = store.sync(os.getenv("MP_API_KEY"), args.elements)
+        print(f"已同步 {n} 个材料，覆盖范围 {args.elements or '全部'}")
+    else:
+        print(json.dumps(store.info(), ensure_ascii=False, indent=2))
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+异步分阶段流程引擎。
+
+每个阶段声明名称、处理函数和所依赖的上游输出名，引擎按依赖关系调度：
+依赖都就绪的阶段立即开始，互不依赖的阶段（如数据源选择与检索都只依赖意图）并发执行。
+多个查询可同时在途，全局并发上限由信号量控制。
+
+每个阶段记录耗时与 token 数：阶段函数内部调用 record_tokens() 上报，
+引擎用 contextvars 把上报归到当前阶段，同步函数在线程中运行时同样有效。
+
+引擎在独立线程中维持一个事件循环，所有查询都在这个循环上执行：同步代码（命令行、HTTP 处理线程）
+通过 run_sync 提交，其他事件循环中 await run() 时也转交到该循环，信号量只属于一个循环，并发上限全局有效。
+"""
+
+import asyncio
+import contextvars
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence
+
+_current_meter: contextvars.ContextVar = contextvars.ContextVar("mp_stage_meter", default=None)
+
+
+def record_tokens(prompt_tokens: int = 0, completion_tokens: int = 0):
+    """阶段函数内调用：把本次 LLM 调用的 token 数计入当前阶段，不在阶段内调用时忽略"""
+    meter = _current_meter.get()
+    if meter is not None:
+        meter["prompt_tokens"] += prompt_tokens
+        meter["completion_tokens"] += completion_tokens
+
+
+class Stage:
+    def __init__(self, name: str, func: Callable, inputs: Sequence[str] = ()):
+        """func 按 inputs 的顺序接收上游输出，可以是普通函数（在线程中运行）或协程函数"""
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inputs)
+
+
+class PipelineEngine:
+    def __init__(self, stages: Iterable[Stage], initial_inputs: Sequence[str] = ("question",),
+                 max_concurrency: int = 4):
+        self.stages: List[Stage] = list(stages)
+        self.initial_inputs = tuple(initial_inputs)
+        self.max_concurrency = max_concurrency
+        # 阶段按声明顺序排列，每个阶段只能依赖初始输入或在它之前声明的阶段
+        known = set(self.initial_inputs)
+        for stage in self.stages:
+            missing = [name for name in stage.inputs if name not in known]
+            if missing:
+                raise ValueError(f"阶段 {stage.name} 依赖未定义的输入: {missing}")
+            if stage.name in known:
+                raise ValueError(f"阶段名重复: {stage.name}")
+            known.add(stage.name)
+
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, float]] = {
+            s.name: {"calls": 0, "errors": 0, "seconds": 0.0, "prompt_tokens": 0, "completion_tokens": 0}
+            for s in self.stages
+        }
+        self._queries = {"started": 0, "finished": 0, "failed": 0, "in_flight": 0, "seconds": 0.0}
+
+    # ---------- 调度 ----------
+    async def _run_stage(self, stage: Stage, upstream: List[asyncio.Future], trace: List[dict]):
+        args = await asyncio.gather(*upstream)
+        meter = {"prompt_tokens": 0, "completion_tokens": 0}
+        token = _current_meter.set(meter)
+        start = time.perf_counter()
+        ok = False
+        try:
+            if asyncio.iscoroutinefunction(stage.func):
+                result = await stage.func(*args)
+            else:
+                # to_thread 会复制当前 context，线程中的 record_tokens 仍计入本阶段
+                result = await asyncio.to_thread(stage.func, *args)
+            ok = True
+            return result
+        finally:
+            _current_meter.reset(token)
+            seconds = time.perf_counter() - start
+            trace.append({"stage": stage.name, "seconds": round(seconds, 4), "ok": ok, **meter})
+            with self._stats_lock:
+                stats = self._stats[stage.name]
+                stats["calls"] += 1
+                stats["errors"] += 0 if ok else 1
+                stats["seconds"] += seconds
+                stats["prompt_tokens"] += meter["prompt_tokens"]
+                stats["completion_tokens"] += meter["completion_tokens"]
+
+    async def run(self, **inputs) -> Dict[str, Any]:
+        """
+        执行一次完整流程，返回 {初始输入..., 各阶段输出..., "trace": [每个阶段的耗时与 token]}。
+        任一阶段失败时取消其余阶段并抛出该异常。可在任意事件循环中 await，实际在引擎的后台循环上执行。
+        """
+        loop = self._ensure_loop()
+        if asyncio.get_running_loop() is loop:
+            return await self._run(**inputs)
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(self._run(**inputs), loop))
+
+    async def _run(self, **inputs) -> Dict[str, Any]:
+        # 只在后台循环上执行，信号量随之只绑定这一个循环
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self._semaphore:
+            self._count("started", "in_flight")
+            start = time.perf_counter()
+            trace: List[dict] = []
+            futures: Dict[str, asyncio.Future] = {}
+            for name in self.initial_inputs:
+                future = asyncio.get_running_loop().create_future()
+                future.set_result(inputs[name])
+                futures[name] = future
+            for stage in self.stages:
+                futures[stage.name] = asyncio.ensure_future(
+                    self._run_stage(stage, [futures[name] for name in stage.inputs], trace)
+                )
+            try:
+                outputs = dict(zip(futures, await asyncio.gather(*futures.values())))
+            except BaseException:
+                for future in futures.values():
+                    future.cancel()
+                self._count("failed")
+                raise
+            finally:
+                with self._stats_lock:
+                    self._queries["in_flight"] -= 1
+                    self._queries["seconds"] += time.perf_counter() - start
+            self._count("finished")
+            outputs["trace"] = trace
+            return outputs
+
+    async def run_many(self, inputs_list: Iterable[Dict[str, Any]], return_exceptions: bool = True) -> list:
+        """多个查询同时提交，受 max_concurrency 限制，结果与输入顺序一致"""
+        return await asyncio.gather(*(self.run(**inputs) for inputs in inputs_list),
+                                    return_exceptions=return_exceptions)
+
+    def _count(self, *keys: str):
+        with self._stats_lock:
+            for key in keys:
+                self._queries[key] += 1
+
+    # ---------- 同步入口 ----------
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        with self._loop_lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="mp-pipeline-loop", daemon=True).start()
+                self._loop = loop
+            return self._loop
+
+    def run_sync(self, **inputs) -> Dict[str, Any]:
+        """在后台事件循环中执行一次流程并等待结果，可从任意线程并发调用"""
+        return asyncio.run_coroutine_threadsafe(self._run(**inputs), self._ensure_loop()).result()
+
+    def run_many_sync(self, inputs_list: Iterable[Dict[str, Any]], return_exceptions: bool = True) -> list:
+        return asyncio.run_coroutine_threadsafe(
+            self.run_many(list(inputs_list), return_exceptions), self._ensure_loop()
+        ).result()
+
+    def close(self):
+        with self._loop_lock:
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                self._loop = None
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                "max_concurrency": self.max_concurrency,
+                "queries": {**self._queries, "seconds": round(self._queries["seconds"], 4)},
+                "stages": {
+                    name: {**s, "seconds": round(s["seconds"], 4)} for name, s in self._stats.items()
+                },
+            }
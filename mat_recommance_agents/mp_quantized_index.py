@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+MP 函数向量的量化存储模式（float16 / int8 标量量化）。
+
+Chroma collection 仍是向量的唯一来源；建索引后从中导出，生成量化副本：
+- codes.npy：float16 或 int8 向量矩阵，常驻内存，做暴力相似度计算
+- scales.npy：int8 模式下每个向量的缩放系数
+- full.npy：可选（build --keep-full）的 float32 原始向量，只以 mmap 方式打开，用于对候选集做精确重排
+- meta.json：模式、维度、向量对应的函数 id 与字段标签
+
+加载时按字段把量化矩阵重排成连续的行段，暴力计算按块反量化到复用的 float32 缓冲区，
+不生成整段 float32 副本；反量化后的块在 DEQUANT_CACHE_MB 预算内缓存，重复查询同一字段时直接复用。
+副本比 manifest 旧（增量更新后未重新导出）时拒绝加载，code_clone_and_index.py 在增量更新后会按原模式重建。
+
+量化副本降低的是检索进程的常驻内存；Chroma collection 仍保留在磁盘上作为数据来源，
+副本是额外的磁盘占用（int8 约为 float32 的 1/4，保留 full.npy 时再加一份 float32），report 会列出各部分的磁盘大小。
+
+检索接口与 FieldVectorIndex.search 一致，返回的距离为平方 L2（向量已归一化时 = 2 - 2cos）。
+
+用法：
+    python mp_quantized_index.py build --mode int8 [--keep-full]
+    python mp_quantized_index.py report
+"""
+
+import argparse
+import json
+import os
+import threading
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from mp_vector_index import DEFAULT_INDEX_DIR, FIELDS, FieldVectorIndex, is_blank_vector
+
+DEFAULT_QUANTIZED_DIR = "./mp_index_q"
+MODES = ("float16", "int8")
+# 先用量化向量取 k * RERANK_FACTOR 个候选，再用原始向量精确重排
+RERANK_FACTOR = 4
+# 分块反量化，限制暴力计算时的临时内存
+SCAN_CHUNK_ROWS = 8192
+# 反量化块缓存预算（MB），0 表示不缓存、每次查询流式反量化
+DEQUANT_CACHE_MB = int(os.getenv("MP_QUANTIZED_CACHE_MB", 256))
+
+
+class StaleQuantizedIndexError(RuntimeError):
+    """量化副本早于 manifest，可能包含已删除的函数或缺少新函数"""
+
+
+def read_meta(index_dir: str = DEFAULT_QUANTIZED_DIR) -> Dict:
+    with open(os.path.join(index_dir, "meta.json"), "r", encoding="utf8") as f:
+        return json.load(f)
+
+
+def quantize(vectors: np.ndarray, mode: str) -> Tuple[np.ndarray, np.ndarray]:
+    if mode == "float16":
+        return vectors.astype(np.float16), np.ones(len(vectors), dtype=np.float32)
+    if mode == "int8":
+        # 逐向量对称量化：code = round(v / scale)，scale = max|v| / 127
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+        return codes, scales.astype(np.float32)
+    raise ValueError(f"未知的量化模式: {mode}")
+
+
+def export_vectors(embedding, index_dir: str = DEFAULT_INDEX_DIR) -> Tuple[np.ndarray, List[str], List[str]]:
+    """从统一 Chroma 索引导出 (float32 向量矩阵, 函数 id, 字段标签)"""
+    fn_ids, fields, chunks = [], [], []
+    for _, embeddings, metadatas in FieldVectorIndex(embedding, index_dir).export():
+        chunks.append(np.asarray(embeddings, dtype=np.float32))
+        fn_ids += [m["id"] for m in metadatas]
+        fields += [m["field"] for m in metadatas]
+    dim = chunks[0].shape[1] if chunks else 0
+    vectors = np.concatenate(chunks) if chunks else np.zeros((0, dim), dtype=np.float32)
+    return vectors, fn_ids, fields
+
+
+def build(embedding, mode: str = "int8", index_dir: str = DEFAULT_INDEX_DIR,
+          out_dir: str = DEFAULT_QUANTIZED_DIR, keep_full: bool = False):
+    """从统一 Chroma 索引导出全部向量并写出量化副本；keep_full=True 时另存 float32 原始向量用于精确重排"""
+    vectors, fn_ids, fields = export_vectors(embedding, index_dir)
+    dim = vectors.shape[1]
+
+    os.makedirs(out_dir, exist_ok=True)
+    codes, scales = quantize(vectors, mode)
+    np.save(os.path.join(out_dir, "codes.npy"), codes)
+    np.save(os.path.join(out_dir, "scales.npy"), scales)
+    full_path = os.path.join(out_dir, "full.npy")
+    if keep_full:
+        np.save(full_path, vectors)
+    elif os.path.exists(full_path):
+        os.remove(full_path)
+    with open(os.path.join(out_dir, "meta.json"), "w", encoding="utf8") as f:
+        json.dump({"mode": mode, "dim": dim, "ids": fn_ids, "fields": fields}, f)
+    print(f"量化索引已写出: {len(fn_ids)} 个向量, 模式 {mode}, 目录 {out_dir}")
+
+
+class QuantizedFieldIndex:
+    def __init__(self, embedding, index_dir: str = DEFAULT_QUANTIZED_DIR, rerank: bool = True,
+                 manifest_path: str = None, cache_mb: int = DEQUANT_CACHE_MB):
+        self.embedding = embedding
+        meta_path = os.path.join(index_dir, "meta.json")
+        if manifest_path and os.path.exists(manifest_path) and os.path.getmtime(manifest_path) > os.path.getmtime(meta_path):
+            raise StaleQuantizedIndexError(f"量化副本 {index_dir} 早于 {manifest_path}，请重新执行 build")
+        meta = read_meta(index_dir)
+        self.mode = meta["mode"]
+        self.fn_ids = meta["ids"]
+        full_path = os.path.join(index_dir, "full.npy")
+        # 原始向量只 mmap，不整体读入内存；重排时只触及候选行
+        self.full = np.load(full_path, mmap_mode="r") if rerank and os.path.exists(full_path) else None
+        self._load_codes(
+            np.load(os.path.join(index_dir, "codes.npy")),
+            np.load(os.path.join(index_dir, "scales.npy")),
+            np.asarray(meta["fields"]),
+            cache_mb,
+        )
+
+    def _load_codes(self, codes: np.ndarray, scales: np.ndarray, fields: np.ndarray, cache_mb: int = 0):
+        """按字段重排为连续行段；order[i] 为重排后第 i 行在原始矩阵（fn_ids / full.npy）中的行号"""
+        self.order = np.argsort(fields, kind="stable")
+        self.codes = np.ascontiguousarray(codes[self.order])
+        self.scales = np.ascontiguousarray(scales[self.order])
+        # float16 模式的缩放系数恒为 1，无需逐行相乘
+        self.scaled = bool(len(self.scales)) and not np.all(self.scales == 1.0)
+        sorted_fields = fields[self.order]
+        self.field_slices: Dict[str, Tuple[int, int]] = {
+            f: (int(np.searchsorted(sorted_fields, f, "left")), int(np.searchsorted(sorted_fields, f, "right")))
+            for f in FIELDS
+        }
+        self.cache_bytes = cache_mb * 2**20
+        self._block_cache: Dict[Tuple[int, int], np.ndarray] = {}
+        self._cached_bytes = 0
+        self._cache_lock = threading.Lock()
+
+    def nbytes(self) -> Dict[str, int]:
+        return {
+            "resident": self.codes.nbytes + self.scales.nbytes,
+            "dequant_cache": self._cached_bytes,
+            "full": self.full.nbytes if self.full is not None else 0,
+        }
+
+    def _dequantized(self, start: int, end: int, buffer: np.ndarray) -> np.ndarray:
+        """[start, end) 行的 float32 块：命中缓存直接返回，否则反量化到 buffer，预算允许时另存一份"""
+        block = self._block_cache.get((start, end))
+        if block is not None:
+            return block
+        block = buffer[:end - start]
+        np.copyto(block, self.codes[start:end], casting="unsafe")
+        if self.scaled:
+            block *= self.scales[start:end, None]
+        with self._cache_lock:
+            if (start, end) not in self._block_cache and self._cached_bytes + block.nbytes <= self.cache_bytes:
+                block = block.copy()
+                self._block_cache[(start, end)] = block
+                self._cached_bytes += block.nbytes
+        return block
+
+    def _approx_scores(self, queries: np.ndarray, start: int, end: int) -> np.ndarray:
+        scores = np.empty((len(queries), end - start), dtype=np.float32)
+        buffer = np.empty((min(SCAN_CHUNK_ROWS, end - start), self.codes.shape[1]), dtype=np.float32)
+        for chunk_start in range(start, end, SCAN_CHUNK_ROWS):
+            chunk_end = min(chunk_start + SCAN_CHUNK_ROWS, end)
+            block = self._dequantized(chunk_start, chunk_end, buffer)
+            np.matmul(queries, block.T, out=scores[:, chunk_start - start:chunk_end - start])
+        return scores
+
+    def search_vectors(self, field: str, queries: np.ndarray, k: int) -> List[List[Tuple[int, float]]]:
+        """同一字段的一组查询向量，返回每个查询的 [(原始行号, 平方 L2 距离)]"""
+        start, end = self.field_slices.get(field, (0, 0))
+        if end <= start or len(queries) == 0:
+            return [[] for _ in range(len(queries))]
+        rows = self.order[start:end]
+        scores = self._approx_scores(queries, start, end)
+        n_candidates = min(len(rows), k * RERANK_FACTOR if self.full is not None else k)
+        results = []
+        for q, row_scores in zip(queries, scores):
+            top = np.argpartition(-row_scores, n_candidates - 1)[:n_candidates]
+            candidates = rows[top]
+            if self.full is not None:
+                # 精确重排：按候选行号顺序读取原始向量
+                order = np.argsort(candidates)
+                candidates = candidates[order]
+                sims = np.asarray(self.full[candidates]) @ q
+            else:
+                sims = row_scores[top]
+            best = np.argsort(-sims)[:k]
+            results.append([(int(candidates[i]), float(2.0 - 2.0 * sims[i])) for i in best])
+        return results
+
+    def search(self, queries: List[Tuple[str, str, int]]) -> List[List[Tuple[str, float]]]:
+        """与 FieldVectorIndex.search 接口一致：queries 为 [(字段, 查询文本, k)]"""
+        hits: List[List[Tuple[str, float]]] = [[] for _ in queries]
+        texts = [text if text.strip() else "" for _, text, _ in queries]
+        if not any(texts):
+            return hits
+        vectors = np.zeros((len(queries), self.codes.shape[1]), dtype=np.float32)
+        non_blank = [i for i, text in enumerate(texts) if text]
+        vectors[non_blank] = np.asarray(self.embedding.embed_documents([texts[i] for i in non_blank]), dtype=np.float32)
+        # 空白文本与零向量查询没有方向，与 FieldVectorIndex 一致返回空结果
+        usable = np.linalg.norm(vectors, axis=1) > 0
+        for field in FIELDS:
+            positions = [i for i, (f, _, _) in enumerate(queries) if f == field and usable[i]]
+            if not positions:
+                continue
+            k = max(queries[i][2] for i in positions)
+            for i, row_hits in zip(positions, self.search_vectors(field, vectors[positions], k)):
+                hits[i] = [(self.fn_ids[row], dist) for row, dist in row_hits[:queries[i][2]]]
+        return hits
+
+    def search_vector(self, field: str, vector, k: int) -> List[Tuple[str, float]]:
+        if is_blank_vector(vector):
+            return []
+        row_hits = self.search_vectors(field, np.asarray(vector, dtype=np.float32)[None, :], k)[0]
+        return [(self.fn_ids[row], dist) for row, dist in row_hits]
+
+
+def dir_size(path: str) -> int:
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, files in os.walk(path) for name in files)
+
+
+def recall_report(embedding, index_dir: str = DEFAULT_INDEX_DIR, quantized_dir: str = DEFAULT_QUANTIZED_DIR,
+                  n_queries: int = 200, k: int = 10, seed: int = 0):
+    """
+    以库中随机向量（加少量噪声）作查询，比较各模式相对 float32 精确检索的 recall@k 与内存占用，并列出磁盘占用。
+    float32 原始向量取自 full.npy，没有时从 Chroma 索引导出。
+    """
+    full_path = os.path.join(quantized_dir, "full.npy")
+    if os.path.exists(full_path):
+        full = np.load(full_path, mmap_mode="r")
+        fields = np.asarray(read_meta(quantized_dir)["fields"])
+    else:
+        full, _, fields = export_vectors(embedding, index_dir)
+        fields = np.asarray(fields)
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(full), size=min(n_queries, len(full)), replace=False)
+    queries = np.asarray(full[np.sort(rows)], dtype=np.float32)
+    queries += rng.normal(scale=0.01, size=queries.shape).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True) + 1e-12
+    query_fields = fields[np.sort(rows)]
+
+    def exact_topk(field, q):
+        field_rows = np.flatnonzero(fields == field)
+        sims = np.asarray(full[field_rows]) @ q
+        return set(field_rows[np.argsort(-sims)[:k]].tolist())
+
+    truth = [exact_topk(f, q) for f, q in zip(query_fields, queries)]
+    print(f"{'mode':<10}{'rerank':<8}{'resident MB':>12}{'x smaller':>11}{'recall@' + str(k):>11}")
+    float32_bytes = full.nbytes
+    for mode in MODES:
+        codes, scales = quantize(np.asarray(full, dtype=np.float32), mode)
+        index = QuantizedFieldIndex.__new__(QuantizedFieldIndex)
+        index.fn_ids = None
+        index._load_codes(codes, scales, fields)
+        resident = codes.nbytes + scales.nbytes
+        for rerank in (False, True):
+            index.full = full if rerank else None
+            hit = 0
+            for f, q, t in zip(query_fields, queries, truth):
+                found = {row for row, _ in index.search_vectors(f, q[None, :], k)[0]}
+                hit += len(found & t)
+            recall = hit / max(1, sum(len(t) for t in truth))
+            print(f"{mode:<10}{str(rerank):<8}{resident / 2**20:>12.2f}{float32_bytes / max(1, resident):>11.1f}{recall:>11.3f}")
+
+    print("磁盘占用 (MB):")
+    print(f"  Chroma 索引 {index_dir}: {dir_size(index_dir) / 2**20:.2f}" if os.path.exists(index_dir) else f"  Chroma 索引 {index_dir}: 不存在")
+    if os.path.exists(os.path.join(quantized_dir, "meta.json")):
+        sidecar = {name: dir_size(os.path.join(quantized_dir, name))
+                   for name in ("codes.npy", "scales.npy", "meta.json", "full.npy")
+                   if os.path.exists(os.path.join(quantized_dir, name))}
+        print(f"  量化副本 {quantized_dir}（{read_meta(quantized_dir)['mode']}）: {sum(sidecar.values()) / 2**20:.2f}"
+              f"，其中 " + "，".join(f"{name} {size / 2**20:.2f}" for name, size in sidecar.items()))
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    from mp_embeddings import make_base_embeddings
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="MP 函数向量的量化存储")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_build = sub.add_parser("build", help="从 Chroma 索引导出并量化")
+    p_build.add_argument("--mode", choices=MODES, default="int8")
+    p_build.add_argument("--keep-full", action="store_true", help="另存 float32 原始向量用于精确重排（额外占用磁盘）")
+    p_report = sub.add_parser("report", help="输出 recall 与体积对比")
+    p_report.add_argument("--queries", type=int, default=200)
+    p_report.add_argument("-k", type=int, default=10)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        build(make_base_embeddings(), args.mode, keep_full=args.keep_full)
+    else:
+        recall_report(make_base_embeddings(), n_queries=args.queries, k=args.k)
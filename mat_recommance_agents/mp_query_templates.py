@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+参数化查询模板缓存。
+
+大多数意图只是同一种 mpr.materials.summary.search(...) 调用换了过滤值。
+意图规范化为模板键（target、数据源、过滤键及其取值形状、是否指定返回字段），过滤值与返回字段作为参数；
+CodeWriter 生成且执行成功的代码中，MPRester 调用参数里与参数值相同的字面量被替换为 PARAMS["参数名"]，存为模板。
+之后同一模板键的意图直接把参数填回模板运行，不再调用 CodeWriter。
+"""
+
+import ast
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from mp_code_validator import attribute_chain, client_names
+
+DEFAULT_TEMPLATE_PATH = "./mp_query_templates.json"
+PARAMS_NAME = "PARAMS"
+
+
+def _shape(value: Any) -> Any:
+    """取值形状：区间条件保留子键，列表 / 标量只保留类型"""
+    if isinstance(value, dict):
+        return {k: _shape(v) for k, v in sorted(value.items())}
+    if isinstance(value, (list, tuple)):
+        return "list"
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, (int, float)):
+        return "number"
+    return "str" if isinstance(value, str) else "other"
+
+
+def canonicalize(intent: dict) -> Tuple[str, Dict[str, Any]]:
+    """返回 (模板键, 参数)；参数名为过滤键（区间条件展开为 "band_gap.min" 形式）和 "fields" """
+    filters = intent.get("filters") or {}
+    fields = list(intent.get("fields") or [])
+    key = json.dumps(
+        {
+            "target": str(intent.get("target", "")).strip().lower(),
+            "datasource": str(intent.get("datasource", "")).strip().lower(),
+            "filters": {k: _shape(v) for k, v in sorted(filters.items())},
+            "fields": bool(fields),
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    params: Dict[str, Any] = {}
+    for name, value in filters.items():
+        if isinstance(value, dict):
+            for sub, sub_value in value.items():
+                params[f"{name}.{sub}"] = sub_value
+        else:
+            params[name] = value
+    if fields:
+        params["fields"] = fields
+    return key, params
+
+
+def _literal(node: ast.AST):
+    try:
+        return ast.literal_eval(node)
+    except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+        return None
+
+
+def _same(a: Any, b: Any) -> bool:
+    """字面量相等：列表与元组视为相同，bool 不与数值混淆"""
+    if isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)):
+        return len(a) == len(b) and all(_same(x, y) for x, y in zip(a, b))
+    if isinstance(a, bool) or isinstance(b, bool):
+        return type(a) is type(b) and a == b
+    if isinstance(a, (int, float)) and isinstance(b, (int, float)):
+        return a == b
+    return type(a) is type(b) and a == b
+
+
+def parameterize(code: str, params: Dict[str, Any]) -> Optional[str]:
+    """
+    把 MPRester 调用（mpr.materials.summary.search(...) 等）参数中等于参数值的字面量替换为 PARAMS["参数名"]。
+    以下情况返回 None（不生成模板）：任一参数在调用参数中找不到；两个参数取值相同无法区分；
+    参数值同时出现在调用参数之外（如 nelements=1 时的 docs[1]），替换后可能执行成功却取错数据。
+    """
+    values = list(params.items())
+    for i, (_, a) in enumerate(values):
+        if any(_same(a, b) for _, b in values[i + 1:]):
+            return None
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return None
+
+    lines = code.splitlines(keepends=True)
+    offsets = [0]
+    for line in lines:
+        offsets.append(offsets[-1] + len(line))
+
+    clients = client_names(tree)
+    call_args = set()  # MPRester 调用参数子树中的全部节点
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call):
+            chain = attribute_chain(node.func)
+            if chain and len(chain) > 1 and chain[0] in clients:
+                for arg in node.args + [k.value for k in node.keywords]:
+                    call_args.update(id(n) for n in ast.walk(arg))
+
+    replacements = []  # (起始偏移, 结束偏移, 参数名)
+    found = set()
+    for node in ast.walk(tree):
+        if not isinstance(node, (ast.Constant, ast.List, ast.Tuple)) or not hasattr(node, "end_lineno"):
+            continue
+        value = _literal(node)
+        if value is None:
+            continue
+        for name, param in values:
+            if _same(value, param):
+                if id(node) not in call_args:
+                    return None
+                start = offsets[node.lineno - 1] + len(lines[node.lineno - 1].encode("utf8")[:node.col_offset].decode("utf8"))
+                end = offsets[node.end_lineno - 1] + len(lines[node.end_lineno - 1].encode("utf8")[:node.end_col_offset].decode("utf8"))
+                replacements.append((start, end, name))
+                found.add(name)
+                break
+    if found != set(params):
+        return None
+
+    # 外层字面量优先（如整个元素列表），丢弃被其包含的内层替换
+    replacements.sort(key=lambda r: (r[0], -r[1]))
+    kept = []
+    for start, end, name in replacements:
+        if kept and start < kept[-1][1]:
+            continue
+        kept.append((start, end, name))
+    for start, end, name in reversed(kept):
+        code = f"{code[:start]}{PARAMS_NAME}[{name!r}]{code[end:]}"
+    return code
+
+
+def fill(template: str, params: Dict[str, Any]) -> str:
+    return f"{PARAMS_NAME} = {params!r}\n{template}"
+
+
+class QueryTemplateCache:
+    def __init__(self, path: str = DEFAULT_TEMPLATE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self.templates: Dict[str, dict] = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf8") as f:
+                self.templates = json.load(f)
+        self.stats = {"hits": 0, "misses": 0, "stored": 0, "not_parameterizable": 0, "fallbacks": 0}
+
+    def lookup(self, intent: dict) -> Optional[str]:
+        """命中时返回填好参数的代码，否则返回 None"""
+        key, params = canonicalize(intent)
+        with self._lock:
+            entry = self.templates.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self.stats["hits"] += 1
+            entry["hits"] = entry.get("hits", 0) + 1
+            return fill(entry["template"], params)
+
+    def store(self, intent: dict, code: str) -> bool:
+        """登记一段执行成功的生成代码，能参数化时写入模板并落盘"""
+        key, params = canonicalize(intent)
+        template = parameterize(code, params)
+        with self._lock:
+            if template is None:
+                self.stats["not_parameterizable"] += 1
+                return False
+            self.templates[key] = {"template": template, "params": sorted(params), "hits": 0, "created": time.time()}
+            self.stats["stored"] += 1
+            self._save()
+            return True
+
+    def invalidate(self, intent: dict):
+        """模板填参后执行失败：删除该模板，本次退回完整生成"""
+        key, _ = canonicalize(intent)
+        with self._lock:
+            self.stats["fallbacks"] += 1
+            if self.templates.pop(key, None) is not None:
+                self._save()
+
+    def _save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf8") as f:
+            json.dump(self.templates, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def info(self) -> dict:
+        with self._lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return {
+                **self.stats,
+                "templates": len(self.templates),
+                "hit_rate": round(self.stats["hits"] / lookups, 4) if lookups else 0.0,
+            }
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+MP 检索器的意图级结果缓存：LRU 容量上限 + TTL 过期 + 索引 manifest 变化时自动失效。
+"""
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Optional
+
+DEFAULT_MANIFEST_PATH = "./mp_index_manifest.json"
+
+
+def normalize_intent(intent: dict) -> str:
+    """
+    检索只依赖 query 文本、filters 的键和 fields，与过滤值无关。
+    归一化后 "Si-O 带隙 > 1eV" 与 "Si-O 带隙 > 2eV" 这类变体共用同一缓存项。
+    """
+    query = " ".join(str(intent.get("query", "")).lower().split())
+    params = sorted({str(p).strip().lower() for p in (intent.get("filters") or {}) if str(p).strip()})
+    fields = sorted({str(f).strip().lower() for f in (intent.get("fields") or []) if str(f).strip()})
+    return json.dumps([query, params, fields], ensure_ascii=False)
+
+
+class IntentCache:
+    def __init__(self, maxsize: int = 1024, ttl: float = 3600, manifest_path: str = DEFAULT_MANIFEST_PATH,
+                 on_invalidate: Optional[Callable[[], None]] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.manifest_path = manifest_path
+        self.on_invalidate = on_invalidate
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (写入时间, 值)
+        self._lock = threading.Lock()
+        self._version = self._manifest_version()
+        self.stats = {"hits": 0, "misses": 0, "expired": 0, "evictions": 0, "invalidations": 0}
+
+    def _manifest_version(self):
+        try:
+            st = os.stat(self.manifest_path)
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def _check_manifest(self):
+        """索引重建后 manifest 会被替换，此时清空缓存并通知调用方重新打开索引"""
+        version = self._manifest_version()
+        if version != self._version:
+            self._version = version
+            self._data.clear()
+            self.stats["invalidations"] += 1
+            if self.on_invalidate is not None:
+                self.on_invalidate()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            self._check_manifest()
+            item = self._data.get(key)
+            if item is None:
+                self.stats["misses"] += 1
+                return None
+            stored_at, value = item
+            if time.monotonic() - stored_at > self.ttl:
+                del self._data[key]
+                self.stats["expired"] += 1
+                self.stats["misses"] += 1
+                return None
+            self._data.move_to_end(key)
+            self.stats["hits"] += 1
+            return value
+
+    def put(self, key: str, value: Any):
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def info(self) -> dict:
+        with self._lock:
+            return {**self.stats, "size": len(self._data), "maxsize": self.maxsize, "ttl": self.ttl}
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+agent 结构化输出：JSON-schema 约束、容错解析与单字段修复。
+
+- structured_llm_config：在支持的服务上通过 response_format 让模型直接按 schema 输出
+- tolerant_json_loads：逐字符扫描取出第一个 JSON 对象，容忍代码块标记、前后说明文字、
+  尾逗号、Python 字面量（True/False/None）以及输出被截断时未闭合的括号和字符串
+- validate：常用 JSON-schema 子集（type / properties / required / enum / items）的校验
+- parse_structured：解析 + 校验，不合格时只发一次修复请求；只有个别字段出错时只让模型重写这些字段
+"""
+
+import json
+import re
+from typing import Any, Callable, List, Optional, Tuple
+
+_TYPES = {
+    "object": dict,
+    "array": list,
+    "string": str,
+    "boolean": bool,
+    "integer": int,
+    "number": (int, float),
+    "null": type(None),
+}
+_PY_LITERALS = {"True": "true", "False": "false", "None": "null"}
+_TRAILING_COMMA_RE = re.compile(r",\s*([}\]])")
+
+
+class StructuredOutputError(ValueError):
+    def __init__(self, message: str, errors: List[Tuple[str, str]] = ()):
+        super().__init__(message)
+        self.errors = list(errors)
+
+
+def structured_llm_config(base_config: dict, name: str, schema: dict) -> dict:
+    """在 llm_config 上附加 response_format（OpenAI 兼容接口的 json_schema 输出模式）"""
+    return {
+        **base_config,
+        "response_format": {
+            "type": "json_schema",
+            "json_schema": {"name": name, "schema": schema, "strict": False},
+        },
+    }
+
+
+# ---------- 容错解析 ----------
+def _scan_object(text: str, start: int) -> str:
+    """从 start 处的 '{' 开始扫描到与之匹配的 '}'；文本提前结束时补齐未闭合的字符串与括号"""
+    closers = []
+    in_string = escaped = False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+            continue
+        if ch == '"':
+            in_string = True
+        elif ch in "{[":
+            closers.append("}" if ch == "{" else "]")
+        elif ch in "}]":
+            if closers:
+                closers.pop()
+            if not closers:
+                return text[start:i + 1]
+    # 输出被截断：补齐字符串引号与剩余括号
+    tail = text[start:].rstrip()
+    if in_string:
+        tail += '"'
+    if tail.endswith(":"):
+        tail += " null"
+    return tail.rstrip(",") + "".join(reversed(closers))
+
+
+def _normalize(candidate: str) -> str:
+    """去掉尾逗号、替换字符串外的 Python 字面量"""
+    out, i = [], 0
+    in_string = escaped = False
+    while i < len(candidate):
+        ch = candidate[i]
+        if in_string:
+            out.append(ch)
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+            i += 1
+            continue
+        if ch == '"':
+            in_string = True
+            out.append(ch)
+            i += 1
+            continue
+        for literal, replacement in _PY_LITERALS.items():
+            if candidate.startswith(literal, i) and not (i and candidate[i - 1].isalnum()):
+                out.append(replacement)
+                i += len(literal)
+                break
+        else:
+            out.append(ch)
+            i += 1
+    return _TRAILING_COMMA_RE.sub(r"\1", "".join(out))
+
+
+def tolerant_json_loads(text: str) -> Any:
+    """从 agent 回复中取出第一个能解析的 JSON 对象"""
+    text = text or ""
+    start = text.find("{")
+    last_error = None
+    while start != -1:
+        candidate = _scan_object(text, start)
+        for attempt in (candidate, _normalize(candidate)):
+            try:
+                return json.loads(attempt)
+            except json.JSONDecodeError as e:
+                last_error = e
+        start = text.find("{", start + 1)
+    raise StructuredOutputError(f"回复中没有可解析的 JSON 对象: {last_error or '未找到 {'}")
+
+
+# ---------- 校验 ----------
+def validate(data: Any, schema: dict, path: str = "") -> List[Tuple[str, str]]:
+    """返回 [(字段路径, 错误说明)]，空列表表示通过"""
+    errors = []
+    expected = schema.get("type")
+    if expected:
+        py_type = _TYPES[expected]
+        # bool 是 int 的子类，数值类型需排除
+        if not isinstance(data, py_type) or (expected in ("integer", "number") and isinstance(data, bool)):
+            return [(path or "$", f"应为 {expected}，实际为 {type(data).__name__}")]
+    if "enum" in schema and data not in schema["enum"]:
+        errors.append((path or "$", f"取值应为 {schema['enum']} 之一，实际为 {data!r}"))
+    if isinstance(data, dict):
+        for key in schema.get("required", []):
+            if key not in data:
+                errors.append((f"{path}.{key}" if path else key, "缺少必填字段"))
+        for key, sub_schema in schema.get("properties", {}).items():
+            if key in data:
+                errors += validate(data[key], sub_schema, f"{path}.{key}" if path else key)
+    if isinstance(data, list) and "items" in schema:
+        for i, item in enumerate(data):
+            errors += validate(item, schema["items"], f"{path}[{i}]")
+    return errors
+
+
+# ---------- 解析 + 修复 ----------
+def _top_field(path: str) -> str:
+    return re.split(r"[.\[]", path, maxsplit=1)[0]
+
+
+def parse_structured(reply: str, schema: dict, ask: Optional[Callable[[str], str]] = None) -> dict:
+    """
+    解析并校验 agent 回复。不合格且提供了 ask（向同一 agent 追加一轮提问的函数）时只修复一次：
+    - 能解析但个别顶层字段不合格：只要求重写这些字段，合并回原对象
+    - 完全无法解析：要求按 schema 重新输出完整 JSON
+    仍不合格则抛出 StructuredOutputError。
+    """
+    try:
+        data = tolerant_json_loads(reply)
+    except StructuredOutputError as e:
+        if ask is None:
+            raise
+        fixed = ask(
+            f"你上一次的输出不是合法 JSON（{e}）。请只输出符合以下 schema 的 JSON 对象，不要输出其他内容：\n"
+            f"{json.dumps(schema, ensure_ascii=False)}\n\n上一次的输出：\n{reply}"
+        )
+        data = tolerant_json_loads(fixed)
+        errors = validate(data, schema)
+        if errors:
+            raise StructuredOutputError(f"修复后的输出仍不符合 schema: {errors}", errors)
+        return data
+
+    errors = validate(data, schema)
+    if not errors:
+        return data
+    if ask is None or not isinstance(data, dict):
+        raise StructuredOutputError(f"输出不符合 schema: {errors}", errors)
+
+    fields = sorted({_top_field(p) for p, _ in errors})
+    sub_schema = {
+        "type": "object",
+        "properties": {f: schema.get("properties", {}).get(f, {}) for f in fields},
+        "required": fields,
+    }
+    fixed = ask(
+        "你上一次输出的 JSON 中以下字段不合格：\n"
+        + "\n".join(f"- {p}: {msg}" for p, msg in errors)
+        + f"\n请只输出包含这些字段的 JSON 对象，符合 schema：\n{json.dumps(sub_schema, ensure_ascii=False)}"
+    )
+    patch = tolerant_json_loads(fixed)
+    if isinstance(patch, dict):
+        data.update({f: patch[f] for f in fields if f in patch})
+    errors = validate(data, schema)
+    if errors:
+        raise StructuredOutputError(f"修复后的输出仍不符合 schema: {errors}", errors)
+    return data
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+MP 函数的统一多字段向量索引。
+
+每个函数的 doc / param / return 三个向量放在同一个 Chroma collection 中，
+向量 id 为 "{函数 id}:{字段}"，metadata 记录 {"id": 函数 id, "field": 字段}。
+检索时所有查询文本一次批量嵌入，再按字段分组，每个字段带 where 过滤做一次近邻查询。
+空白字段（如大多数函数的 returns）不建向量：零向量在 L2 空间里与任何单位查询向量的距离都是 1，
+会压过余弦相似度低于 0.5 的真实命中。检索时缺少某字段向量的函数只是不出现在该字段的结果中。
+"""
+
+from typing import Dict, Iterable, List, Tuple
+
+from langchain_community.vectorstores import Chroma
+
+FIELDS = ("doc", "param", "return")
+DEFAULT_INDEX_DIR = "./mp_index"
+COLLECTION_NAME = "mp_functions"
+# 导出全部向量时每页条数
+EXPORT_PAGE_SIZE = 5000
+
+
+def vector_id(fn_id: str, field: str) -> str:
+    return f"{fn_id}:{field}"
+
+
+def is_blank_vector(vector) -> bool:
+    """零向量（空白文本、本地哈希嵌入下不含任何词的文本）没有方向，不能参与 L2 近邻检索"""
+    return not any(vector)
+
+
+class FieldVectorIndex:
+    def __init__(self, embedding, persist_directory: str = DEFAULT_INDEX_DIR):
+        self.embedding = embedding
+        self.store = Chroma(
+            collection_name=COLLECTION_NAME,
+            persist_directory=persist_directory,
+            embedding_function=embedding,
+        )
+
+    def delete(self, fn_ids: Iterable[str]):
+        ids = [vector_id(i, field) for i in fn_ids for field in FIELDS]
+        if ids:
+            self.store.delete(ids=ids)
+
+    def upsert(self, items: List[Tuple[str, Dict[str, str]]]):
+        """
+        items: [(函数 id, {"doc": ..., "param": ..., "return": ...})]
+        三个字段的文本合并成一次批量嵌入，嵌入层可以跨字段去重；空白文本与零向量不写入
+        """
+        if not items:
+            return
+        self.delete([fn_id for fn_id, _ in items])
+        texts, metadatas, ids = [], [], []
+        for fn_id, field_texts in items:
+            for field in FIELDS:
+                if not field_texts[field].strip():
+                    continue
+                texts.append(field_texts[field])
+                metadatas.append({"id": fn_id, "field": field})
+                ids.append(vector_id(fn_id, field))
+        if not texts:
+            return
+        vectors = self.embedding.embed_documents(texts)
+        keep = [i for i, v in enumerate(vectors) if not is_blank_vector(v)]
+        if keep:
+            self.store._collection.upsert(
+                ids=[ids[i] for i in keep],
+                embeddings=[vectors[i] for i in keep],
+                metadatas=[metadatas[i] for i in keep],
+                documents=[texts[i] for i in keep],
+            )
+
+    def search(self, queries: List[Tuple[str, str, int]]) -> List[List[Tuple[str, float]]]:
+        """
+        queries: [(字段, 查询文本, k)]
+        返回与 queries 对齐的列表，每项为该查询在对应字段上命中的 [(函数 id, 距离)]；
+        空白查询文本或零向量查询返回空列表
+        """
+        hits: List[List[Tuple[str, float]]] = [[] for _ in queries]
+        positions = [i for i, (_, text, _) in enumerate(queries) if text.strip()]
+        if not positions:
+            return hits
+        vectors = self.embedding.embed_documents([queries[i][1] for i in positions])
+        valid = [(i, v) for i, v in zip(positions, vectors) if not is_blank_vector(v)]
+        if not valid:
+            return hits
+        # 按字段过滤查询，其他字段的向量不会挤占本字段的 top-k
+        for field in FIELDS:
+            group = [(i, v) for i, v in valid if queries[i][0] == field]
+            if not group:
+                continue
+            result = self.store._collection.query(
+                query_embeddings=[v for _, v in group],
+                n_results=max(queries[i][2] for i, _ in group),
+                where={"field": field},
+                include=["metadatas", "distances"],
+            )
+            for (i, _), metadatas, distances in zip(group, result["metadatas"], result["distances"]):
+                hits[i] = [(m["id"], d) for m, d in zip(metadatas, distances)][:queries[i][2]]
+        return hits
+
+    def search_vector(self, field: str, vector: List[float], k: int) -> List[Tuple[str, float]]:
+        """单条已嵌入的查询：带字段过滤的精确 top-k，供并发检索模式使用"""
+        if is_blank_vector(vector):
+            return []
+        result = self.store._collection.query(
+            query_embeddings=[vector],
+            n_results=k,
+            where={"field": field},
+            include=["metadatas", "distances"],
+        )
+        return [(m["id"], d) for m, d in zip(result["metadatas"][0], result["distances"][0])]
+
+    def export(self, page_size: int = EXPORT_PAGE_SIZE):
+        """分页导出全部向量，逐页产出 (向量 id, 向量, metadata)，供量化副本等离线处理使用"""
+        offset = 0
+        while True:
+            page = self.store._collection.get(
+                include=["embeddings", "metadatas"], limit=page_size, offset=offset
+            )
+            if not page["ids"]:
+                return
+            yield page["ids"], page["embeddings"], page["metadatas"]
+            offset += len(page["ids"])
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+常驻预热的代码执行进程池。
+
+LocalCommandLineCodeExecutor 每个代码块都启动一个新的解释器，numpy / matplotlib / mp_api
+每次都要重新导入，单块开销以秒计。这里改为维持若干个常驻的工作进程（虚拟环境中的 python）：
+- 启动时预先导入常用模块，之后每个代码块在全新的全局命名空间中执行，互不共享变量
+- 父子进程之间通过 stdin / 独立的管道按行传递 JSON，代码中的 print 不会干扰协议
+- 每个进程执行 max_runs 次或峰值内存超过 max_memory_mb 后回收重建；超时的进程直接杀掉重建
+- 多个相互独立的代码块可以分配给不同进程并行执行
+
+WarmCodeExecutor 实现了 autogen 的 CodeExecutor 接口，可直接用于 code_execution_config={"executor": ...}。
+"""
+
+import json
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Sequence
+
+from autogen.coding import CodeBlock, MarkdownCodeExtractor
+from autogen.coding.base import CommandLineCodeResult
+
+DEFAULT_PRELOAD = ("numpy", "pandas", "matplotlib", "matplotlib.pyplot", "mp_api.client")
+TIMEOUT_EXIT_CODE = 124
+CANCELLED_EXIT_CODE = 130
+# 等待结果时检查取消信号的间隔（秒）
+CANCEL_POLL_INTERVAL = 0.05
+
+# 工作进程脚本：协议使用启动时复制出的原 stdout，之后把 fd 1 指向 stderr，
+# 这样代码块里直接写 fd 1 的输出（子进程、C 扩展）也不会混进协议（这部分输出不收集）
+WORKER_SOURCE = r'''
+import contextlib, io, json, os, sys, traceback
+proto = os.fdopen(os.dup(1), "w", encoding="utf8")
+os.dup2(2, 1)
+sys.stdout = sys.stderr
+for name in json.loads(sys.argv[1]):
+    try:
+        __import__(name)
+    except Exception:
+        pass
+sys.path.insert(0, os.getcwd())
+try:
+    import resource
+    # ru_maxrss 在 Linux 上以 KB 为单位，macOS 上以字节为单位
+    RSS_UNIT = 1024 * 1024 if sys.platform == "darwin" else 1024
+    def peak_mb():
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / RSS_UNIT
+except ImportError:
+    def peak_mb():
+        return 0.0
+proto.write(json.dumps({"ready": True}) + "\n")
+proto.flush()
+for line in sys.stdin:
+    request = json.loads(line)
+    buffer = io.StringIO()
+    exit_code = 0
+    with contextlib.redirect_stdout(buffer), contextlib.redirect_stderr(buffer):
+        try:
+            exec(compile(request["code"], request.get("filename", "<code>"), "exec"), {"__name__": "__main__"})
+        except SystemExit as e:
+            if e.code not in (None, 0):
+                exit_code = e.code if isinstance(e.code, int) else 1
+                if not isinstance(e.code, int):
+                    print(e.code)
+        except BaseException:
+            exit_code = 1
+            traceback.print_exc()
+    proto.write(json.dumps({"id": request["id"], "exit_code": exit_code,
+                            "output": buffer.getvalue(), "peak_mb": peak_mb()}) + "\n")
+    proto.flush()
+'''
+
+
+class _Worker:
+    def __init__(self, python: str, work_dir: str, preload: Sequence[str], env: dict):
+        self.runs = 0
+        self.peak_mb = 0.0
+        self.proc = subprocess.Popen(
+            [python, "-u", "-c", WORKER_SOURCE, json.dumps(list(preload))],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            cwd=work_dir,
+            env=env,
+            text=True,
+            encoding="utf8",
+            bufsize=1,
+        )
+        self._replies: "queue.Queue[Optional[dict]]" = queue.Queue()
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def _read(self):
+        for line in self.proc.stdout:
+            try:
+                self._replies.put(json.loads(line))
+            except ValueError:
+                continue
+        self._replies.put(None)  # 进程退出
+
+    def wait_ready(self, timeout: float) -> bool:
+        try:
+            reply = self._replies.get(timeout=timeout)
+        except queue.Empty:
+            return False
+        return bool(reply and reply.get("ready"))
+
+    def run(self, code: str, timeout: float, cancel: Optional[threading.Event] = None) -> CommandLineCodeResult:
+        """cancel 被置位时杀掉进程并返回取消结果（投机执行中落选的候选）"""
+        request_id = uuid.uuid4().hex
+        try:
+            self.proc.stdin.write(json.dumps({"id": request_id, "code": code}) + "\n")
+            self.proc.stdin.flush()
+        except (BrokenPipeError, OSError):
+            # 回收进程，_release 看到已退出会补一个新的
+            self.kill()
+            return CommandLineCodeResult(exit_code=1, output="执行进程已退出")
+        self.runs += 1
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if cancel is not None and cancel.is_set():
+                self.kill()
+                return CommandLineCodeResult(exit_code=CANCELLED_EXIT_CODE, output="已取消")
+            try:
+                wait = min(remaining, CANCEL_POLL_INTERVAL) if cancel is not None else remaining
+                reply = self._replies.get(timeout=max(0.0, wait))
+            except queue.Empty:
+                if time.monotonic() < deadline:
+                    continue
+                self.kill()
+                return CommandLineCodeResult(exit_code=TIMEOUT_EXIT_CODE, output=f"执行超时（{timeout} 秒）")
+            if reply is None:
+                # stdout 已关闭但进程可能尚未被回收，poll() 仍为 None，必须先 wait
+                self.kill()
+                return CommandLineCodeResult(exit_code=1, output="执行进程意外退出")
+            # 未调用 wait_ready 时先收到的是就绪消息
+            if reply.get("id") == request_id:
+                break
+        self.peak_mb = reply.get("peak_mb", 0.0)
+        return CommandLineCodeResult(exit_code=reply["exit_code"], output=reply["output"])
+
+    def alive(self) -> bool:
+        return self.proc.poll() is None
+
+    def kill(self):
+        if self.alive():
+            self.proc.kill()
+        self.proc.wait()
+
+
+class WarmExecutorPool:
+    def __init__(
+        self,
+        python: str = sys.executable,
+        size: int = 2,
+        work_dir: str = "coding",
+        preload: Sequence[str] = DEFAULT_PRELOAD,
+        timeout: float = 200,
+        max_runs: int = 50,
+        max_memory_mb: float = 2048,
+        env: Optional[dict] = None,
+    ):
+        self.python = python
+        self.size = size
+        self.work_dir = os.path.abspath(work_dir)
+        self.preload = tuple(preload)
+        self.timeout = timeout
+        self.max_runs = max_runs
+        self.max_memory_mb = max_memory_mb
+        self.env = {**os.environ, "MPLBACKEND": "Agg", **(env or {})}
+        os.makedirs(self.work_dir, exist_ok=True)
+        self._idle: "queue.Queue[_Worker]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._closed = False
+        self.stats = {"runs": 0, "spawned": 0, "recycled": 0, "timeouts": 0, "cancelled": 0, "seconds": 0.0}
+        for _ in range(size):
+            self._idle.put(self._spawn())
+
+    def _spawn(self) -> _Worker:
+        worker = _Worker(self.python, self.work_dir, self.preload, self.env)
+        with self._lock:
+            self.stats["spawned"] += 1
+        return worker
+
+    def _release(self, worker: _Worker):
+        """归还进程；达到次数 / 内存上限或已退出的进程回收后补一个新的"""
+        if self._closed:
+            worker.kill()
+            return
+        if not worker.alive() or worker.runs >= self.max_runs or worker.peak_mb >= self.max_memory_mb:
+            worker.kill()
+            with self._lock:
+                self.stats["recycled"] += 1
+            worker = self._spawn()
+        self._idle.put(worker)
+
+    def run(self, code: str, timeout: Optional[float] = None,
+            cancel: Optional[threading.Event] = None) -> CommandLineCodeResult:
+        """借一个空闲进程执行一段 python 代码；cancel 置位时中止并回收该进程"""
+        worker = self._idle.get()
+        start = time.perf_counter()
+        try:
+            result = worker.run(code, timeout or self.timeout, cancel)
+        finally:
+            self._release(worker)
+        with self._lock:
+            self.stats["runs"] += 1
+            self.stats["seconds"] += time.perf_counter() - start
+            if result.exit_code == TIMEOUT_EXIT_CODE:
+                self.stats["timeouts"] += 1
+            elif result.exit_code == CANCELLED_EXIT_CODE:
+                self.stats["cancelled"] += 1
+        return result
+
+    def run_many(self, codes: Sequence[str], timeout: Optional[float] = None) -> List[CommandLineCodeResult]:
+        """相互独立的代码并行执行（最多 size 个同时），结果与输入顺序一致"""
+        if len(codes) <= 1:
+            return [self.run(code, timeout) for code in codes]
+        with ThreadPoolExecutor(max_workers=min(self.size, len(codes))) as pool:
+            return list(pool.map(lambda code: self.run(code, timeout), codes))
+
+    def warm_up(self, timeout: float = 120) -> bool:
+        """等待全部进程完成预导入"""
+        workers = [self._idle.get() for _ in range(self.size)]
+        ready = all(worker.wait_ready(timeout) for worker in workers)
+        for worker in workers:
+            self._idle.put(worker)
+        return ready
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().kill()
+            except queue.Empty:
+                break
+
+    def info(self) -> dict:
+        with self._lock:
+            return {**self.stats, "seconds": round(self.stats["seconds"], 4), "size": self.size}
+
+
+class WarmCodeExecutor:
+    """
+    autogen CodeExecutor 接口的常驻进程实现：python 代码块交给 WarmExecutorPool，
+    sh / bash 代码块仍以子进程执行（PATH 优先指向虚拟环境）。
+    virtual_env_context 为 create_virtual_env 的返回值，省略时使用当前解释器。
+    """
+
+    def __init__(self, virtual_env_context=None, timeout: float = 200, work_dir: str = "coding",
+                 pool_size: int = 2, preload: Sequence[str] = DEFAULT_PRELOAD,
+                 max_runs: int = 50, max_memory_mb: float = 2048):
+        self.timeout = timeout
+        self.work_dir = os.path.abspath(work_dir)
+        env = {}
+        python = sys.executable
+        if virtual_env_context is not None:
+            python = virtual_env_context.env_exe
+            env["PATH"] = f"{virtual_env_context.bin_path}{os.pathsep}{os.environ.get('PATH', '')}"
+        self._env = {**os.environ, **env}
+        self.pool = WarmExecutorPool(python, pool_size, work_dir, preload, timeout, max_runs, max_memory_mb, env)
+
+    @property
+    def code_extractor(self) -> MarkdownCodeExtractor:
+        return MarkdownCodeExtractor()
+
+    def _run_shell(self, code: str) -> CommandLineCodeResult:
+        try:
+            proc = subprocess.run(["bash", "-c", code], cwd=self.work_dir, env=self._env,
+                                  capture_output=True, text=True, timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            return CommandLineCodeResult(exit_code=TIMEOUT_EXIT_CODE, output=f"执行超时（{self.timeout} 秒）")
+        return CommandLineCodeResult(exit_code=proc.returncode, output=proc.stdout + proc.stderr)
+
+    def _run_block(self, block: CodeBlock) -> CommandLineCodeResult:
+        lang = block.language.lower()
+        if lang in ("python", "py", "python3", ""):
+            return self.pool.run(block.code, self.timeout)
+        if lang in ("sh", "bash", "shell"):
+            return self._run_shell(block.code)
+        return CommandLineCodeResult(exit_code=1, output=f"不支持的代码语言: {block.language}")
+
+    def execute_code_blocks(self, code_blocks: List[CodeBlock]) -> CommandLineCodeResult:
+        """与 LocalCommandLineCodeExecutor 一致：按顺序执行，遇到失败即停止，输出依次拼接"""
+        outputs = []
+        exit_code = 0
+        for block in code_blocks:
+            result = self._run_block(block)
+            outputs.append(result.output)
+            exit_code = result.exit_code
+            if exit_code != 0:
+                break
+        return CommandLineCodeResult(exit_code=exit_code, output="".join(outputs))
+
+    def execute_independent_blocks(self, code_blocks: List[CodeBlock]) -> List[CommandLineCodeResult]:
+        """互不依赖的 python 代码块并行执行，返回与输入对齐的结果列表"""
+        if all(b.language.lower() in ("python", "py", "python3", "") for b in code_blocks):
+            return self.pool.run_many([b.code for b in code_blocks], self.timeout)
+        return [self._run_block(b) for b in code_blocks]
+
+    def restart(self):
+        self.pool.close()
+        self.pool = WarmExecutorPool(self.pool.python, self.pool.size, self.pool.work_dir, self.pool.preload,
+                                     self.pool.timeout, self.pool.max_runs, self.pool.max_memory_mb, self.pool.env)
@@ -1,6 +1,7 @@
 from autogen import AssistantAgent, ConversableAgent
 from dotenv import load_dotenv
 import os
+import sys
 
 load_dotenv()
 
@@ -25,11 +26,23 @@ venv_dir = "~/llm_env"
 venv_context = create_virtual_env(venv_dir)  # 创建虚拟环境，并返回虚拟环境上下文，若虚拟环境已存在，则返回已存在的虚拟环境上下文
 
 # 创建本地命令行代码执行器，指定虚拟环境、超时时间和工作目录
-executor = LocalCommandLineCodeExecutor(
-    virtual_env_context=venv_context,
-    timeout=200,
-    work_dir="coding",
-)
+# 默认使用常驻预热的执行进程池（numpy / matplotlib 只导入一次），WARM_EXECUTOR=0 时每个代码块启动新的解释器
+if os.getenv("WARM_EXECUTOR", "1") == "1":
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mat_recommance_agents"))
+    from warm_executor import WarmCodeExecutor
+
+    executor = WarmCodeExecutor(
+        virtual_env_context=venv_context,
+        timeout=200,
+        work_dir="coding",
+        preload=("numpy", "pandas", "matplotlib", "matplotlib.pyplot"),
+    )
+else:
+    executor = LocalCommandLineCodeExecutor(
+        virtual_env_context=venv_context,
+        timeout=200,
+        work_dir="coding",
+    )
 #测试虚拟环境中的 Python 解释器路径
 print(
     executor.execute_code_blocks(code_blocks=[CodeBlock(language="python", code="import sys; print(sys.executable)")])
@@ -129,6 +129,22 @@ executor = LocalCommandLineCodeExecutor(
 print(executor.execute_code_blocks(code_blocks=[CodeBlock(language="python", code="import sys; print(sys.executable)")]))
 ### 1. 自定义函数的注册与智能体调用 ###
 
+# 上面的首次执行已把自定义函数写入 coding/functions.py；对话中的代码块改由常驻预热的执行进程池执行，
+# 进程启动时预先导入 numpy / matplotlib 和 functions 模块，WARM_EXECUTOR=0 时仍使用上面的执行器
+if os.getenv("WARM_EXECUTOR", "1") == "1":
+    import sys
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mat_recommance_agents"))
+    from warm_executor import WarmCodeExecutor
+
+    chat_executor = WarmCodeExecutor(
+        virtual_env_context=venv_context,
+        timeout=200,
+        work_dir="coding",
+        preload=("numpy", "pandas", "matplotlib", "matplotlib.pyplot", "functions"),
+    )
+else:
+    chat_executor = executor
+
 code_writer_agent_system_message = """
 你是一位专业的 Python 数据分析师，负责根据用户需求编写高质量、可运行的 Python 代码。请严格按照以下要求执行任务，并确保代码详细注释。
 1. **信息收集阶段：**
@@ -167,7 +183,7 @@ code_writer_agent = AssistantAgent(
 code_executor_agent = ConversableAgent(
     name="code_executor_agent",
     llm_config=False,
-    code_execution_config={"executor": executor},
+    code_execution_config={"executor": chat_executor},
     human_input_mode="ALWAYS",
     default_auto_reply="请继续，如果所有工作都准备好了，请回复'终止'"
 )